@@ -35,11 +35,12 @@
     'author': 'Compassion CH',
     'website': 'http://www.compassion.ch',
     'category': 'Accounting',
-    'depends': ['analytic', 'account_fiscal_month'],
+    'depends': ['analytic', 'account_fiscal_month', 'queue_job'],
     'external_dependencies': {},
     'data': [
         'security/ir.model.access.csv',
         'data/analytic_tag.xml',
+        'data/attribution_config.xml',
         'views/analytic_attribution_view.xml',
     ],
     'demo': [],
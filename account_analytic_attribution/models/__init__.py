@@ -10,3 +10,6 @@
 ##############################################################################
 from . import account_analytic_attribution
 from . import account_analytic_distribution_line
+from . import account_analytic_attribution_snapshot
+from . import account_analytic_attribution_batch
+from . import account_analytic_line
@@ -8,12 +8,55 @@
 #    The licence is in the file __manifest__.py
 #
 ##############################################################################
+import hashlib
+from collections import defaultdict
 from datetime import datetime
 
 from odoo.tools import relativedelta
 
 from odoo import api, models, fields
 
+from odoo.addons.queue_job.job import job
+
+
+class AttributionIndex(object):
+    """
+    In-memory index of the attribution rules, used to find the rule of many
+    (analytic account, general account) pairs without a query for each.
+    Rules are indexed by (account tag, analytic tag) and keep the order of
+    the attribution model.
+    """
+
+    def __init__(self, rules):
+        self.rules = rules.browse()
+        self.index = defaultdict(list)
+        for position, rule in enumerate(rules):
+            key = (rule.account_tag_id.id, rule.analytic_tag_id.id)
+            self.index[key].append(
+                (position, rule.date_start, rule.date_stop, rule.id))
+
+    def get_attribution(self, account_tag_ids, analytic_tag_ids, date):
+        """ Find the first rule valid for the given tags and date. """
+        if not isinstance(date, basestring):
+            date = fields.Date.to_string(date)
+        found = None
+        for key, rules in self.index.iteritems():
+            account_tag_id, analytic_tag_id = key
+            if account_tag_ids and account_tag_id and \
+                    account_tag_id not in account_tag_ids:
+                continue
+            if analytic_tag_ids and analytic_tag_id and \
+                    analytic_tag_id not in analytic_tag_ids:
+                continue
+            for position, date_start, date_stop, rule_id in rules:
+                if found and found[0] < position:
+                    break
+                if (not date_start or date_start <= date) and \
+                        (not date_stop or date_stop >= date):
+                    found = (position, rule_id)
+                    break
+        return self.rules.browse(found and found[1] or [])
+
 
 class AccountAttribution(models.Model):
     """
@@ -43,54 +86,96 @@ class AccountAttribution(models.Model):
     @api.model
     def get_attribution(self, account_tag_ids, analytic_tag_ids, date):
         """ Find a valid distribution rule given some data. """
-        domain = [
-            '|', ('date_start', '<=', date), ('date_start', '=', False),
-            '|', ('date_stop', '>=', date), ('date_stop', '=', False)
-        ]
-        if account_tag_ids:
-            domain += ['|', ('account_tag_id', 'in', account_tag_ids),
-                       ('account_tag_id', '=', False)]
+        return self._get_attribution_index().get_attribution(
+            account_tag_ids, analytic_tag_ids, date)
 
-        if analytic_tag_ids:
-            domain += ['|', ('analytic_tag_id', 'in', analytic_tag_ids),
-                       ('analytic_tag_id', '=', False)]
+    @api.model
+    def _get_attribution_index(self):
+        """ Load all the attribution rules in an index. """
+        return AttributionIndex(self.search([]))
 
-        return self.search(domain, limit=1)
+    @api.multi
+    def _get_checksum(self):
+        """ Checksum of the distribution of the rules, used to know if the
+        attribution of a pair must be done again. """
+        distribution = [
+            (line.attribution_id.id, line.account_analytic_id.id, line.rate)
+            for line in self.mapped('account_distribution_line_ids')
+        ]
+        return hashlib.md5(repr(sorted(distribution))).hexdigest()
 
     @api.model
-    def perform_distribution(self, date_start=None, date_stop=None):
+    def perform_distribution(self, date_start=None, date_stop=None,
+                             incremental=False):
         """
         Perform the attribution of the analytic lines.
         The attribution is done for each general account.
         By default it takes the last fiscal year for the computation.
+        In incremental mode, only the (analytic account, general account)
+        pairs whose total or rule changed since the last attribution of the
+        period are attributed again.
+        :return: account.analytic.line recordset of the generated lines
         """
         date_start, date_stop = self._compute_dates(date_start, date_stop)
-        analytic_line_obj = self.env['account.analytic.line']
         tag_id = self.env.ref(
             'account_analytic_attribution.tag_attribution').id
+        snapshot_obj = self.env['account.analytic.attribution.snapshot']
+        snapshots = snapshot_obj.search([
+            ('date_start', '=', date_start),
+            ('date_stop', '=', date_stop)])
+        if not incremental or not snapshots:
+            self._remove_old_attributions(date_start, date_stop, tag_id)
+            snapshots = snapshot_obj
+        previous_snapshots = {
+            (s.analytic_account_id.id, s.general_account_id.id): s
+            for s in snapshots
+        }
+        currency = self.env.user.company_id.currency_id
 
-        analytic_lines = self._filter_analytic_lines_and_removed_old_ones(
-            date_start, date_stop, tag_id)
-        generated_lines = analytic_line_obj
-
-        attribution_amounts = self._aggregate_by_account(analytic_lines)
+        attribution_amounts = self._aggregate_by_account(
+            self._get_analytic_lines_domain(date_start, date_stop, tag_id))
 
         # Attribute the amounts
-        analytic_account_obj = self.env['account.analytic.account']
-        account_obj = self.env['account.account']
-        for analytic_id, attribution in attribution_amounts.iteritems():
+        attribution_index = self._get_attribution_index()
+        analytics = self.env['account.analytic.account'].browse(
+            attribution_amounts.keys())
+        accounts = self.env['account.account'].browse(list(set(
+            account_id for attribution in attribution_amounts.itervalues()
+            for account_id in attribution if account_id)))
+        account_tags = {account.id: account.tag_ids.ids
+                        for account in accounts}
+        lines_vals = list()
+        snapshots_vals = list()
+        outdated_ids = list()
+        for analytic in analytics:
+            analytic_tag_ids = analytic.tag_ids.ids
+            attribution = attribution_amounts[analytic.id]
             for account_id, amount_total in attribution.iteritems():
-                account = account_obj.browse(account_id)
-                account_tag_ids = account.tag_ids.ids
-                analytic = analytic_account_obj.browse(analytic_id)
-                analytic_tag_ids = analytic.tag_ids.ids
-                attribution_rule = self.get_attribution(
-                    account_tag_ids, analytic_tag_ids, date_stop)
+                attribution_rule = attribution_index.get_attribution(
+                    account_tags.get(account_id), analytic_tag_ids,
+                    date_stop)
+                checksum = attribution_rule._get_checksum()
+                snapshot = previous_snapshots.pop(
+                    (analytic.id, account_id), None)
+                if snapshot:
+                    if snapshot.rule_checksum == checksum and not \
+                            currency.compare_amounts(
+                                snapshot.amount_total, amount_total):
+                        continue
+                    outdated_ids.append(snapshot.id)
+                snapshots_vals.append({
+                    'date_start': date_start,
+                    'date_stop': date_stop,
+                    'analytic_account_id': analytic.id,
+                    'general_account_id': account_id,
+                    'amount_total': amount_total,
+                    'rule_checksum': checksum,
+                })
                 if attribution_rule:
                     prefix = (analytic.code and
                               analytic.code + '-') or ''
                     for rule in attribution_rule.account_distribution_line_ids:
-                        line = analytic_line_obj.create({
+                        lines_vals.append({
                             'name': 'Analytic attribution for ' +
                                     analytic.name,
                             'account_id': rule.account_analytic_id.id,
@@ -99,10 +184,48 @@ class AccountAttribution(models.Model):
                             'amount': amount_total * (rule.rate / 100),
                             'general_account_id': account_id,
                             'ref': prefix + analytic.name,
+                            'attribution_source_id': analytic.id,
                         })
-                        generated_lines += line
 
-        return generated_lines
+        # Pairs having no analytic lines anymore are removed as well
+        outdated_ids.extend(s.id for s in previous_snapshots.itervalues())
+        outdated = snapshot_obj.browse(outdated_ids)
+        self._remove_pair_attributions(
+            outdated, date_start, date_stop, tag_id)
+        outdated.unlink()
+        for vals in snapshots_vals:
+            snapshot_obj.create(vals)
+
+        return self._create_analytic_lines(lines_vals)
+
+    @api.model
+    @job(default_channel='root.analytic_attribution')
+    def _perform_distribution_job(self, date_start, date_stop,
+                                  incremental=False):
+        """ Job performing the attribution of a period.
+        :return: number of generated lines, stored as the job result
+        """
+        return len(self.perform_distribution(
+            date_start, date_stop, incremental))
+
+    @api.model
+    def _create_analytic_lines(self, lines_vals):
+        """
+        Create the generated analytic lines by chunks. Computed fields are
+        recomputed once per chunk instead of once per line.
+        :param lines_vals: list of dict of account.analytic.line values
+        :return: account.analytic.line recordset
+        """
+        analytic_line_obj = self.env['account.analytic.line'].with_context(
+            recompute=False)
+        chunk_size = max(int(self.env['ir.config_parameter'].get_param(
+            'account_analytic_attribution.create_chunk_size', 500)), 1)
+        line_ids = list()
+        for index in range(0, len(lines_vals), chunk_size):
+            for vals in lines_vals[index:index + chunk_size]:
+                line_ids.append(analytic_line_obj.create(vals).id)
+            analytic_line_obj.recompute()
+        return self.env['account.analytic.line'].browse(line_ids)
 
     def _compute_dates(self, date_start=None, date_stop=None):
         if not date_start or not date_stop:
@@ -114,8 +237,7 @@ class AccountAttribution(models.Model):
             date_stop = fields.Date.to_string(fy['date_to'])
         return date_start, date_stop
 
-    def _filter_analytic_lines_and_removed_old_ones(self, date_start,
-                                                    date_stop, tag_id):
+    def _remove_old_attributions(self, date_start, date_stop, tag_id):
         analytic_line_obj = self.env['account.analytic.line']
         # Remove old attributions for avoiding duplicates
         old_lines = analytic_line_obj.search([
@@ -123,26 +245,66 @@ class AccountAttribution(models.Model):
             ('date', '>=', date_start),
             ('date', '<=', date_stop)])
         old_lines.unlink()
+        # Lines are dated at the end of their period: the lines of other
+        # periods ending in the range are removed as well, so their
+        # snapshots must not prevent attributing them again.
+        self.env['account.analytic.attribution.snapshot'].search([
+            ('date_stop', '>=', date_start),
+            ('date_stop', '<=', date_stop)]).unlink()
 
-        # Perform the attribution for each analytic line
-        return analytic_line_obj.search([
+    def _remove_pair_attributions(self, snapshots, date_start, date_stop,
+                                  tag_id):
+        """ Remove the attribution lines generated for the pairs of the given
+        snapshots. """
+        if not snapshots:
+            return
+        pairs = set((s.analytic_account_id.id, s.general_account_id.id)
+                    for s in snapshots)
+        old_lines = self.env['account.analytic.line'].search([
+            ('tag_ids', '=', tag_id),
+            ('date', '>=', date_start),
+            ('date', '<=', date_stop),
+            ('attribution_source_id', 'in',
+             snapshots.mapped('analytic_account_id').ids)])
+        old_lines.filtered(lambda l: (
+            l.attribution_source_id.id, l.general_account_id.id) in pairs
+        ).unlink()
+        # Same for the snapshots of these pairs in other periods ending in
+        # the range, see _remove_old_attributions.
+        other_snapshots = self.env[
+            'account.analytic.attribution.snapshot'].search([
+                ('id', 'not in', snapshots.ids),
+                ('date_stop', '>=', date_start),
+                ('date_stop', '<=', date_stop),
+                ('analytic_account_id', 'in',
+                 snapshots.mapped('analytic_account_id').ids)])
+        other_snapshots.filtered(lambda s: (
+            s.analytic_account_id.id, s.general_account_id.id) in pairs
+        ).unlink()
+
+    def _get_analytic_lines_domain(self, date_start, date_stop, tag_id):
+        """ Domain of the analytic lines to attribute in the period.
+        Generated attribution lines are never attributed again. """
+        return [
             ('date', '>=', date_start),
             ('date', '<=', date_stop),
-        ])
+            ('tag_ids', '!=', tag_id),
+        ]
 
-    @staticmethod
-    def _aggregate_by_account(analytic_lines):
+    @api.model
+    def _aggregate_by_account(self, domain):
         """
         # Get the total amount to attribute for each analytic account
+        # with one grouped query on the analytic lines of the domain
         #   ->   {analytic_id: {general_account_id: total}}
         """
-        attribution_amounts = dict()
-        for line in analytic_lines:
-            analytic_id = line.account_id.id
-            account_id = line.general_account_id.id
-            analytic_attribution = attribution_amounts.get(analytic_id, {
-                account_id: 0.0})
-            total = analytic_attribution.get(account_id, 0.0) + line.amount
-            analytic_attribution[account_id] = total
-            attribution_amounts[analytic_id] = analytic_attribution
+        attribution_amounts = defaultdict(dict)
+        totals = self.env['account.analytic.line'].read_group(
+            domain, ['account_id', 'general_account_id', 'amount'],
+            ['account_id', 'general_account_id'], lazy=False)
+        for total in totals:
+            analytic_id = total['account_id'] and total['account_id'][0]
+            account_id = total['general_account_id'] and \
+                total['general_account_id'][0]
+            attribution_amounts[analytic_id][account_id] = total['amount']
         return attribution_amounts
@@ -0,0 +1,105 @@
+# -*- coding: utf-8 -*-
+##############################################################################
+#
+#    Copyright (C) 2018 Compassion CH (http://www.compassion.ch)
+#    Releasing children from poverty in Jesus' name
+#
+#    The licence is in the file __manifest__.py
+#
+##############################################################################
+from odoo import api, models, fields, _
+
+
+class AttributionBatch(models.Model):
+    """
+    Attribution launched for several date ranges, one job being enqueued for
+    each of them. It is kept to follow the progress of the jobs, which can
+    run for hours.
+    """
+    _name = "account.analytic.attribution.batch"
+    _description = "Analytic Attribution Batch"
+    _order = "create_date desc"
+
+    date_range_ids = fields.Many2many(
+        'date.range', 'attribution_batch_date_range_rel',
+        string='Date range', readonly=True
+    )
+    incremental = fields.Boolean(readonly=True)
+    job_ids = fields.Many2many(
+        'queue.job', 'attribution_batch_queue_job_rel',
+        string='Attribution jobs', readonly=True
+    )
+    state = fields.Selection([
+        ('draft', _('Draft')),
+        ('running', _('Running')),
+        ('done', _('Done')),
+    ], compute='_compute_progress')
+    progress = fields.Float(compute='_compute_progress')
+    nb_jobs_done = fields.Integer('Done', compute='_compute_progress')
+    nb_jobs_failed = fields.Integer('Failed', compute='_compute_progress')
+
+    @api.depends('job_ids.state')
+    def _compute_progress(self):
+        for batch in self:
+            # Jobs are read by accountants without access to the queue
+            jobs = batch.sudo().job_ids
+            nb_done = len(jobs.filtered(lambda j: j.state == 'done'))
+            nb_failed = len(jobs.filtered(lambda j: j.state == 'failed'))
+            if not jobs:
+                batch.state = 'draft'
+            elif nb_done + nb_failed == len(jobs):
+                batch.state = 'done'
+            else:
+                batch.state = 'running'
+            batch.nb_jobs_done = nb_done
+            batch.nb_jobs_failed = nb_failed
+            batch.progress = 100.0 * (nb_done + nb_failed) / (
+                len(jobs) or 1)
+
+    @api.multi
+    def launch(self):
+        """ Enqueue one attribution job for each date range of the batch.
+        """
+        self.ensure_one()
+        attribution_obj = self.env['account.analytic.attribution']
+        uuids = list()
+        for date_range in self.date_range_ids:
+            uuids.append(attribution_obj.with_delay(
+                description=_('Analytic attribution of ') + date_range.name
+            )._perform_distribution_job(
+                date_range.date_start, date_range.date_end, self.incremental
+            ).uuid)
+        self.job_ids = self.env['queue.job'].sudo().search(
+            [('uuid', 'in', uuids)])
+        return self.open_batch()
+
+    @api.multi
+    def open_batch(self):
+        """ Show the batch with the progress of its jobs. """
+        self.ensure_one()
+        return {
+            'name': _('Analytic Attribution'),
+            'view_mode': 'form',
+            'view_type': 'form',
+            'res_model': self._name,
+            'res_id': self.id,
+            'type': 'ir.actions.act_window',
+        }
+
+    @api.multi
+    def open_generated_lines(self):
+        """ Show the lines generated for all date ranges. """
+        self.ensure_one()
+        tag = self.env.ref('account_analytic_attribution.tag_attribution')
+        return {
+            'name': _('Generated Analytic Lines'),
+            'view_mode': 'tree,form',
+            'view_type': 'form',
+            'res_model': 'account.analytic.line',
+            'domain': [
+                ('tag_ids', '=', tag.id),
+                ('date', 'in', self.date_range_ids.mapped('date_end')),
+            ],
+            'context': {'group_by': ['ref']},
+            'type': 'ir.actions.act_window',
+        }
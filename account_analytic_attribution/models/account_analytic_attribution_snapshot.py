@@ -0,0 +1,32 @@
+# -*- coding: utf-8 -*-
+##############################################################################
+#
+#    Copyright (C) 2018 Compassion CH (http://www.compassion.ch)
+#    Releasing children from poverty in Jesus' name
+#
+#    The licence is in the file __manifest__.py
+#
+##############################################################################
+from odoo import models, fields
+
+
+class AttributionSnapshot(models.Model):
+    """
+    State of the attribution of an (analytic account, general account) pair
+    for a period, used by the incremental attribution to find which pairs
+    changed since the last attribution.
+    """
+    _name = "account.analytic.attribution.snapshot"
+    _description = "Analytic Attribution Snapshot"
+
+    date_start = fields.Date(required=True, index=True)
+    date_stop = fields.Date(required=True)
+    analytic_account_id = fields.Many2one(
+        'account.analytic.account', 'Analytic Account', required=True,
+        ondelete='cascade'
+    )
+    general_account_id = fields.Many2one(
+        'account.account', 'Financial Account', ondelete='cascade'
+    )
+    amount_total = fields.Float('Attributed amount')
+    rule_checksum = fields.Char()
@@ -0,0 +1,20 @@
+# -*- coding: utf-8 -*-
+##############################################################################
+#
+#    Copyright (C) 2018 Compassion CH (http://www.compassion.ch)
+#    Releasing children from poverty in Jesus' name
+#
+#    The licence is in the file __manifest__.py
+#
+##############################################################################
+from odoo import models, fields
+
+
+class AnalyticLine(models.Model):
+    _inherit = "account.analytic.line"
+
+    attribution_source_id = fields.Many2one(
+        'account.analytic.account', 'Attributed from', index=True,
+        readonly=True, help='Analytic account whose amount was attributed '
+                            'by this line.'
+    )
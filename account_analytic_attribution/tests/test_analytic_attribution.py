@@ -56,6 +56,97 @@ class TestAnalyticAttribution(TransactionCase):
         attribution.perform_distribution()
         self._assert_analytic_lines_count(0)
 
+    def test_aggregate_by_account__excludes_generated_lines(self):
+        self._create_line_with_amount_twelve(self.analytic_account)
+        self._create_line_with_amount_twelve(self.analytic_account)
+        generated = self._create_line_with_amount_twelve(
+            self.analytic_account)
+        generated.tag_ids += self.tag
+
+        domain = self.Attribution._get_analytic_lines_domain(
+            '2017-01-01', '2017-12-31', self.tag.id)
+        totals = self.Attribution._aggregate_by_account(domain)
+        self.assertEqual(totals.keys(), [self.analytic_account.id])
+        self.assertEqual(totals[self.analytic_account.id], {1: 24.0})
+
+    def test_perform_distribution__incremental(self):
+        other_account = self.env["account.analytic.account"] \
+            .create({"name": "Other Account"})
+        self._create_line_with_amount_twelve(self.analytic_account)
+        self._create_line_with_amount_twelve(other_account)
+        attribution = self.Attribution.create({})
+        self.env['account.analytic.distribution.line'].create({
+            'rate': 50,
+            'account_analytic_id': self.analytic_account.id,
+            'attribution_id': attribution.id
+        })
+        date_start, date_stop = '2017-01-01', '2017-12-31'
+        lines = self.Attribution.perform_distribution(date_start, date_stop)
+        self.assertEqual(len(lines), 2)
+
+        # Nothing changed: no line is generated again
+        self.assertFalse(self.Attribution.perform_distribution(
+            date_start, date_stop, incremental=True))
+
+        # Only the changed account is attributed again
+        self._create_line_with_amount_twelve(other_account)
+        new_line = self.Attribution.perform_distribution(
+            date_start, date_stop, incremental=True)
+        self.assertEqual(new_line.attribution_source_id, other_account)
+        self.assertAlmostEqual(new_line.amount, 12.0)  # 50% of (2*12)
+        kept_line = lines.exists()
+        self.assertEqual(kept_line.attribution_source_id,
+                         self.analytic_account)
+        # The job only stores the number of generated lines
+        self.assertEqual(self.Attribution._perform_distribution_job(
+            date_start, date_stop, incremental=True), 0)
+
+    def test_perform_distribution__overlapping_periods(self):
+        self._create_line_with_amount_twelve(self.analytic_account)
+        attribution = self.Attribution.create({})
+        self.env['account.analytic.distribution.line'].create({
+            'rate': 50,
+            'account_analytic_id': self.analytic_account.id,
+            'attribution_id': attribution.id
+        })
+        month_start, month_stop = '2017-05-01', '2017-05-31'
+        self.Attribution.perform_distribution(month_start, month_stop)
+
+        # The yearly run removes the lines of the month
+        year_line = self.Attribution.perform_distribution(
+            '2017-01-01', '2017-12-31')
+        self.assertEqual(year_line.date, '2017-12-31')
+        self.assertFalse(self.env['account.analytic.line'].search([
+            ('tag_ids', '=', self.tag.id), ('date', '=', month_stop)]))
+
+        # The month is attributed again, though its amounts didn't change
+        month_line = self.Attribution.perform_distribution(
+            month_start, month_stop, incremental=True)
+        self.assertEqual(month_line.date, month_stop)
+        self.assertAlmostEqual(month_line.amount, 6.0)  # 50% of 12
+        self.assertTrue(year_line.exists())
+
+    def test_wizard__one_job_per_date_range(self):
+        range_type = self.env['date.range.type'].create({
+            'name': 'Test months'})
+        date_ranges = self.env['date.range']
+        for month in ('05', '06'):
+            date_ranges += date_ranges.create({
+                'name': '2017-' + month,
+                'type_id': range_type.id,
+                'date_start': '2017-%s-01' % month,
+                'date_end': '2017-%s-28' % month,
+            })
+        wizard = self.env['account.analytic.attribution.wizard'].create({
+            'date_range_ids': [(6, 0, date_ranges.ids)]})
+
+        action = wizard.perform_distribution()
+        batch = self.env[action['res_model']].browse(action['res_id'])
+        self.assertEqual(batch.date_range_ids, date_ranges)
+        self.assertEqual(len(batch.job_ids), 2)
+        self.assertEqual(batch.state, 'running')
+        self.assertEqual(batch.progress, 0.0)
+
     def test_get_attribution__match_if_filters_are_not_set(self):
         attribution = self.Attribution.create({})
         self.env['account.analytic.distribution.line'].create({
@@ -95,6 +186,18 @@ class TestAnalyticAttribution(TransactionCase):
         matched = attribution.get_attribution(False, [self.tag.id], now)
         self.assertEqual(len(matched), 1)
 
+    def test_get_attribution__first_rule_by_sequence(self):
+        generic = self.Attribution.create({'sequence': 1})
+        tagged = self.Attribution.create({'sequence': 2})
+        tagged.analytic_tag_id += self.tag
+
+        index = self.Attribution._get_attribution_index()
+        now = datetime.now()
+        self.assertEqual(index.get_attribution(
+            False, [self.tag.id], now), tagged)
+        self.assertEqual(index.get_attribution(False, [99], now), generic)
+        self.assertEqual(index.get_attribution(False, False, now), tagged)
+
     def _create_line_with_amount_twelve(self, account):
         return self.env['account.analytic.line'].create({
             'name': 'test line',
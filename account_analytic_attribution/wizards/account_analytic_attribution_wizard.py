@@ -9,7 +9,7 @@
 #
 ##############################################################################
 
-from odoo import api, models, fields, _
+from odoo import api, models, fields
 
 
 class AttributionWizard(models.TransientModel):
@@ -23,23 +23,30 @@ class AttributionWizard(models.TransientModel):
         domain=[('type_id.fiscal_month', '=', True)],
         help='Takes the current year if none is selected.'
     )
+    incremental = fields.Boolean(
+        help='Only attribute again the analytic accounts whose amounts or '
+             'attribution rules changed since the last attribution.'
+    )
 
     @api.multi
     def perform_distribution(self):
-        """ Perform analytic attributions. """
+        """ Perform analytic attributions. The date ranges are independent:
+        a batch enqueuing one job for each of them is created. Context value
+        async_mode set to False can force to perform the attributions
+        immediately.
+        """
         self.ensure_one()
-        lines = self.env['account.analytic.line']
-        for date_range in self.date_range_ids:
-            lines += self.env[
-                'account.analytic.attribution'].perform_distribution(
-                date_range.date_start, date_range.date_end)
-
-        return {
-            'name': _('Generated Analytic Lines'),
-            'view_mode': 'tree,form',
-            'view_type': 'form',
-            'res_model': 'account.analytic.line',
-            'domain': [('id', 'in', lines.ids)],
-            'context': {'group_by': ['ref']},
-            'type': 'ir.actions.act_window',
+        batch_obj = self.env['account.analytic.attribution.batch']
+        batch_vals = {
+            'date_range_ids': [(6, 0, self.date_range_ids.ids)],
+            'incremental': self.incremental,
         }
+        if not self.env.context.get('async_mode', True):
+            attribution_obj = self.env['account.analytic.attribution']
+            for date_range in self.date_range_ids:
+                attribution_obj.perform_distribution(
+                    date_range.date_start, date_range.date_end,
+                    self.incremental)
+            # Nothing to follow: the batch is not saved
+            return batch_obj.new(batch_vals).open_generated_lines()
+        return batch_obj.create(batch_vals).launch()
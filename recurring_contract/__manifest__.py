@@ -30,7 +30,7 @@
 {
     'name': 'Recurring contract',
     'summary': 'Contract for recurring invoicing',
-    'version': '10.0.1.0.0',
+    'version': '10.0.1.2.0',
     'license': 'AGPL-3',
     'author': 'Compassion CH',
     'website': 'http://www.compassion.ch',
@@ -47,6 +47,7 @@
         'data/recurring_invoicer_sequence.xml',
         'data/contract_expire_cron.xml',
         'data/daily_invoicer_cron.xml',
+        'data/recurring_contract_config.xml',
         'security/ir.model.access.csv',
     ],
     'installable': True,
@@ -0,0 +1,48 @@
+# -*- coding: utf-8 -*-
+##############################################################################
+#
+#    Copyright (C) 2018 Compassion CH (http://www.compassion.ch)
+#    Releasing children from poverty in Jesus' name
+#
+#    The licence is in the file __manifest__.py
+#
+##############################################################################
+from openupgradelib import openupgrade
+
+
+@openupgrade.migrate(use_env=False)
+def migrate(cr, version):
+    if not version:
+        return
+
+    # Create and fill the new stored fields in SQL, to avoid the
+    # recomputation of all contracts through the ORM.
+    for table in ('recurring_contract', 'recurring_contract_group'):
+        if not openupgrade.column_exists(
+                cr, table, 'last_paid_invoice_date'):
+            openupgrade.logged_query(cr, """
+                ALTER TABLE {0} ADD COLUMN last_paid_invoice_date DATE;
+            """.format(table))
+
+    openupgrade.logged_query(cr, """
+        UPDATE recurring_contract c
+        SET last_paid_invoice_date = paid.last_date
+        FROM (
+            SELECT l.contract_id, MAX(i.date_invoice) AS last_date
+            FROM account_invoice_line l
+            JOIN account_invoice i ON i.id = l.invoice_id
+            WHERE l.contract_id IS NOT NULL AND i.state = 'paid'
+            GROUP BY l.contract_id
+        ) paid
+        WHERE paid.contract_id = c.id;
+    """)
+    openupgrade.logged_query(cr, """
+        UPDATE recurring_contract_group g
+        SET last_paid_invoice_date = paid.last_date
+        FROM (
+            SELECT group_id, MAX(last_paid_invoice_date) AS last_date
+            FROM recurring_contract
+            GROUP BY group_id
+        ) paid
+        WHERE paid.group_id = g.id;
+    """)
@@ -0,0 +1,39 @@
+# -*- coding: utf-8 -*-
+##############################################################################
+#
+#    Copyright (C) 2018 Compassion CH (http://www.compassion.ch)
+#    Releasing children from poverty in Jesus' name
+#
+#    The licence is in the file __manifest__.py
+#
+##############################################################################
+from openupgradelib import openupgrade
+
+
+@openupgrade.migrate(use_env=False)
+def migrate(cr, version):
+    if not version:
+        return
+
+    # Count the invoices of all contracts with a single grouped query,
+    # instead of recomputing the new stored field through the ORM.
+    if not openupgrade.column_exists(cr, 'recurring_contract', 'nb_invoices'):
+        openupgrade.logged_query(cr, """
+            ALTER TABLE recurring_contract ADD COLUMN nb_invoices INTEGER;
+        """)
+    openupgrade.logged_query(cr, """
+        UPDATE recurring_contract SET nb_invoices = 0;
+    """)
+    openupgrade.logged_query(cr, """
+        UPDATE recurring_contract c
+        SET nb_invoices = inv.nb_invoices
+        FROM (
+            SELECT l.contract_id, COUNT(DISTINCT l.invoice_id) AS nb_invoices
+            FROM account_invoice_line l
+            JOIN account_invoice i ON i.id = l.invoice_id
+            WHERE l.contract_id IS NOT NULL
+            AND i.state NOT IN ('cancel', 'draft')
+            GROUP BY l.contract_id
+        ) inv
+        WHERE inv.contract_id = c.id;
+    """)
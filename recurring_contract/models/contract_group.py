@@ -10,16 +10,83 @@
 ##############################################################################
 
 import logging
+import math
+import resource
+import time
+import traceback
+from collections import defaultdict
+from contextlib import contextmanager
 from datetime import datetime
 from dateutil.relativedelta import relativedelta
+from psycopg2 import OperationalError
 
 from odoo import api, fields, models, _
-from odoo.tools import config
+from odoo.service.model import PG_CONCURRENCY_ERRORS_TO_RETRY
+from odoo.tools import config, ustr
 
 from odoo.addons.queue_job.job import job, related_action
 
 logger = logging.getLogger(__name__)
 test_mode = config.get('test_enable')
+# First key of the advisory locks serializing the validation of invoices,
+# the second key being the id of the sequence of the journal.
+POSTING_LOCK_KEY = 1003
+
+
+class GenerationStats(object):
+    """ Metrics collected by an invoice generation job. """
+    PHASES = ('setup', 'create', 'validate', 'next_date', 'commit', 'lock')
+
+    def __init__(self):
+        self.times = dict.fromkeys(self.PHASES, 0.0)
+        self.group_times = list()
+        self.nb_invoices = 0
+        self.nb_invoice_lines = 0
+        self.nb_failures = 0
+        self.memory_peak = 0
+
+    @contextmanager
+    def measure(self, phase):
+        """ Add the wall time of the enclosed code to the given phase. """
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.times[phase] += time.time() - start
+
+    def add_groups(self, group_times, invoices):
+        """ Register the groups and invoices of a successful chunk. """
+        self.group_times.extend(group_times)
+        self.nb_invoices += len(invoices)
+        self.nb_invoice_lines += len(invoices.mapped('invoice_line_ids'))
+
+    def sample_memory(self):
+        """ Read the memory high-water mark of the process (in MB). """
+        # ru_maxrss is given in kilobytes on Linux
+        self.memory_peak = resource.getrusage(
+            resource.RUSAGE_SELF).ru_maxrss // 1024
+
+    def percentile(self, percent):
+        """ Time per group below which given percent of the groups are. """
+        if not self.group_times:
+            return 0.0
+        times = sorted(self.group_times)
+        index = int(math.ceil(percent / 100.0 * len(times))) - 1
+        return times[max(index, 0)]
+
+    def get_values(self, **values):
+        """ Values to write on the recurring.invoicer.shard. """
+        values.update({
+            'nb_invoices': self.nb_invoices,
+            'nb_invoice_lines': self.nb_invoice_lines,
+            'nb_failures': self.nb_failures,
+            'time_group_p50': self.percentile(50),
+            'time_group_p95': self.percentile(95),
+            'memory_peak': self.memory_peak,
+        })
+        for phase, duration in self.times.iteritems():
+            values['time_' + phase] = duration
+        return values
 
 
 class ContractGroup(models.Model):
@@ -51,7 +118,7 @@ class ContractGroup(models.Model):
         string='Next invoice date', store=True)
     last_paid_invoice_date = fields.Date(
         compute='_compute_last_paid_invoice',
-        string='Last paid invoice date')
+        string='Last paid invoice date', store=True, index=True)
 
     change_method = fields.Selection(
         '_get_change_methods', default='do_nothing')
@@ -76,12 +143,31 @@ class ContractGroup(models.Model):
 
     @api.depends('contract_ids.next_invoice_date', 'contract_ids.state')
     def _compute_next_invoice_date(self):
-        for group in self:
+        """ The dates of saved groups are computed with one grouped query,
+        using the index on (group_id, next_invoice_date) of contracts. """
+        gen_states = self._get_gen_states()
+        stored_groups = self.filtered('id')
+        next_dates = dict()
+        if stored_groups:
+            self.env.cr.execute("""
+                SELECT group_id,
+                       CASE WHEN bool_or(next_invoice_date IS NULL)
+                       THEN NULL ELSE MIN(next_invoice_date) END
+                FROM recurring_contract
+                WHERE group_id = ANY(%s) AND state = ANY(%s)
+                GROUP BY group_id
+            """, [stored_groups.ids, gen_states])
+            next_dates = dict(self.env.cr.fetchall())
+        for group in stored_groups:
+            group.next_invoice_date = fields.Date.to_string(
+                next_dates.get(group.id)) or False
+        for group in self - stored_groups:
             next_inv_date = min(
                 [c.next_invoice_date for c in group.contract_ids
-                 if c.state in self._get_gen_states()] or [False])
+                 if c.state in gen_states] or [False])
             group.next_invoice_date = next_inv_date
 
+    @api.depends('contract_ids.last_paid_invoice_date')
     def _compute_last_paid_invoice(self):
         for group in self:
             group.last_paid_invoice_date = max(
@@ -91,6 +177,16 @@ class ContractGroup(models.Model):
     ##########################################################################
     #                              ORM METHODS                               #
     ##########################################################################
+    @api.model_cr
+    def init(self):
+        """ Only groups with active contracts have a next invoice date:
+        index them for the daily invoicer, see _search_due_groups. """
+        self.env.cr.execute("""
+            CREATE INDEX IF NOT EXISTS
+            recurring_contract_group_due_work_index
+            ON recurring_contract_group (next_invoice_date)
+            WHERE next_invoice_date IS NOT NULL
+        """)
 
     @api.multi
     def write(self, vals):
@@ -145,18 +241,119 @@ class ContractGroup(models.Model):
             invoicer = self.env['recurring.invoicer'].create(
                 {'source': self._name})
         if self.env.context.get('async_mode', True):
-            # Prevent two generations at the same time
-            jobs = self.env['queue.job'].search([
-                ('channel', '=', 'root.recurring_invoicer'),
-                ('state', '=', 'started')])
-            delay = datetime.today()
-            if jobs:
-                delay += relativedelta(minutes=1)
-            self.with_delay(eta=delay)._generate_invoices(invoicer)
+            # Shards are disjoint and can be generated concurrently.
+            # Each job locks the groups it generates, see _lock_groups.
+            for groups in self._split_in_shards(self._get_nb_shards()):
+                shard = invoicer.add_shard(groups)
+                groups.with_delay()._generate_invoices(invoicer, shard)
         else:
             self._generate_invoices(invoicer)
         return invoicer
 
+    @api.model
+    def _get_nb_shards(self):
+        """ Number of concurrent jobs used for generating invoices. It
+        should not exceed the capacity of the root.recurring_invoicer
+        channel, otherwise some shards will wait for the others. """
+        return self._get_generation_param('generation_shards', 1)
+
+    @api.model
+    def _get_chunk_size(self):
+        """ Number of groups generated between two commits. """
+        return self._get_generation_param('generation_chunk_size', 10)
+
+    @api.model
+    def _get_generation_param(self, key, default):
+        """ Read a positive integer setting of the invoice generation. """
+        return max(int(self.env['ir.config_parameter'].get_param(
+            'recurring_contract.' + key, default)), 1)
+
+    @api.multi
+    def _split_in_shards(self, nb_shards):
+        """ Split the groups in disjoint batches, using the partner of the
+        group as key. This way, all groups of a partner are generated by
+        the same job and two jobs never lock the same partner.
+        :param nb_shards: maximum number of batches
+        :return: list of recurring.contract.group recordsets
+        """
+        shards = [list() for i in range(nb_shards)]
+        for group in self:
+            shards[group.partner_id.id % nb_shards].append(group.id)
+        return [self.browse(group_ids) for group_ids in shards if group_ids]
+
+    @api.model
+    def _search_due_groups(self, date_limit):
+        """ Find the groups having contracts to invoice until given date.
+        The search uses the partial index on next_invoice_date.
+        :param date_limit: date or string
+        :return: recurring.contract.group recordset
+        """
+        return self.search([
+            ('next_invoice_date', '<=', date_limit),
+            ('next_invoice_date', '!=', False)])
+
+    @api.multi
+    def get_invoice_forecast(self, nb_months=12):
+        """ Project the amounts that will be invoiced in the coming months,
+        without creating any invoice. The contracts are stepped in memory
+        the same way the invoice generation does.
+        :param nb_months: forecast horizon in months
+        :return: list of dictionaries with keys month (YYYY-MM),
+                 product_id, payment_mode_id and amount
+        """
+        limit_date = datetime.today() + relativedelta(months=+nb_months)
+        gen_states = self._get_gen_states()
+        forecast = defaultdict(float)
+        contracts = self.mapped('contract_ids').filtered(
+            lambda c: c.state in gen_states and c.next_invoice_date
+        ).with_context(product_inv_data=dict())
+        # Prefetch all contract lines and products at once
+        contracts._cache_products_inv_data()
+        contracts_by_group = defaultdict(list)
+        for contract in contracts:
+            contracts_by_group[contract.group_id.id].append(contract)
+        for group in self:
+            group_contracts = contracts_by_group[group.id]
+            if not group_contracts:
+                continue
+            delta = group.get_relative_delta()
+            payment_mode_id = group.payment_mode_id.id
+            next_dates = {
+                c: fields.Datetime.from_string(c.next_invoice_date)
+                for c in group_contracts
+            }
+            lines_data = dict()
+            current_date = min(next_dates.values())
+            while current_date <= limit_date:
+                due_contracts = [
+                    c for c, date in next_dates.iteritems()
+                    if date <= current_date and not (
+                        c.end_date and
+                        c.end_date >= fields.Date.to_string(date))
+                ]
+                if not due_contracts:
+                    break
+                month = min(next_dates[c] for c in due_contracts).strftime(
+                    '%Y-%m')
+                for contract in due_contracts:
+                    if contract not in lines_data:
+                        lines_data[contract] = [
+                            invl for invl in contract.get_inv_lines_data()
+                            if invl]
+                    for invl in lines_data[contract]:
+                        key = (month, invl['product_id'], payment_mode_id)
+                        forecast[key] += invl['price_unit'] * invl['quantity']
+                    next_dates[contract] += delta
+                current_date += delta
+
+        return [{
+            'month': month,
+            'product_id': product_id,
+            'payment_mode_id': payment_mode_id,
+            'amount': amount,
+        } for (month, product_id, payment_mode_id), amount in sorted(
+            forecast.iteritems())]
+
     @api.multi
     def get_relative_delta(self):
         """
@@ -182,66 +379,292 @@ class ContractGroup(models.Model):
     @api.multi
     @job(default_channel='root.recurring_invoicer')
     @related_action(action='related_action_invoicer')
-    def _generate_invoices(self, invoicer=None):
+    def _generate_invoices(self, invoicer=None, shard=None):
         """ Checks all contracts and generate invoices if needed.
         Create an invoice per contract group per date.
+        Groups are processed in chunks: invoices of a chunk are validated
+        together and a commit is done after each chunk. Only the records of
+        the current chunk are kept in cache, so that the memory used by the
+        job does not grow with the number of groups.
+        :param invoicer: recurring.invoicer holding generated invoices
+        :param shard: recurring.invoicer.shard tracking the progress
         """
         logger.info("Invoice generation started.")
-        if invoicer is None:
-            invoicer = self.env['recurring.invoicer'].create(
-                {'source': self._name})
-        inv_obj = self.env['account.invoice']
-        gen_states = self._get_gen_states()
-        journal = self.env['account.journal'].search(
-            [('type', '=', 'sale'), ('company_id', '=', 1)], limit=1)
-
-        nb_groups = len(self)
-        count = 1
-        for contract_group in self.filtered('next_invoice_date'):
-            # After a ContractGroup is done, we commit all writes in order to
-            # avoid doing it again in case of an error or a timeout
-            if not test_mode:
+        stats = GenerationStats()
+        with stats.measure('setup'):
+            if invoicer is None:
+                invoicer = self.env['recurring.invoicer'].create(
+                    {'source': self._name})
+            if shard is None:
+                shard = invoicer.add_shard(self)
+            shard.start()
+            journal = self.env['account.journal'].search(
+                [('type', '=', 'sale'), ('company_id', '=', 1)], limit=1)
+
+            # Product data is cached for the whole run
+            groups = self.with_context(product_inv_data=dict())
+            group_ids = groups._get_due_group_ids()
+        if not test_mode:
+            # Each chunk starts with a new transaction, whose snapshot does
+            # not miss the groups committed by the other jobs.
+            with stats.measure('commit'):
                 self.env.cr.commit()    # pylint: disable=invalid-commit
-            logger.info("Generating invoices for group {0}/{1}".format(
-                count, nb_groups))
-            month_delta = contract_group.advance_billing_months or 1
-            limit_date = datetime.today() + relativedelta(
-                months=+month_delta)
-            current_date = fields.Datetime.from_string(
-                contract_group.next_invoice_date)
-            while current_date <= limit_date:
-                contracts = contract_group.contract_ids.filtered(
-                    lambda c: c.next_invoice_date and
-                    fields.Datetime.from_string(
-                        c.next_invoice_date) <= current_date and
-                    c.state in gen_states and not (
-                        c.end_date and c.end_date >= c.next_invoice_date)
-                )
-                if not contracts:
-                    break
-                try:
-                    inv_data = contract_group._setup_inv_data(
-                        journal, invoicer, contracts)
-                    invoice = inv_obj.create(inv_data)
-                    if invoice.invoice_line_ids:
-                        invoice.action_invoice_open()
-                    else:
-                        invoice.unlink()
-                    if not self.env.context.get('no_next_date_update'):
-                        contracts.update_next_invoice_date()
-                    current_date += contract_group.get_relative_delta()
-                except:
-                    self.env.cr.rollback()
-                    self.env.invalidate_all()
-                    logger.error(
-                        'contract group {0} failed during invoice generation'.
-                        format(contract_group.id),
-                        exc_info=True)
-                    break
-            count += 1
+        nb_groups = len(group_ids)
+        chunk_size = self._get_chunk_size()
+        for index in range(0, nb_groups, chunk_size):
+            # A new prefetch per chunk avoids loading the next groups
+            chunk = groups.browse(
+                group_ids[index:index + chunk_size]).with_prefetch()
+            logger.info("Generating invoices for groups {0}-{1}/{2}".format(
+                index + 1, index + len(chunk), nb_groups))
+            with chunk._lock_invoice_posting(journal, stats):
+                failed_groups = chunk._generate_chunk_invoices(
+                    journal, invoicer, shard, stats)
+                stats.nb_failures += len(failed_groups)
+                # After a chunk is done, we commit all writes in order to
+                # avoid doing it again in case of an error or a timeout
+                stats.sample_memory()
+                shard.write(stats.get_values(
+                    nb_groups_done=index + len(chunk)))
+                if not test_mode:
+                    with stats.measure('commit'):
+                        self.env.cr.commit()  # pylint: disable=invalid-commit
+            # Records of the chunk are not needed anymore
+            chunk._invalidate_generation_cache(invoicer)
+        shard.write(stats.get_values(nb_groups_done=len(self)))
+        shard.finish()
         logger.info("Invoice generation successfully finished.")
         return invoicer
 
+    @api.multi
+    def _get_due_group_ids(self):
+        """ Ids of the groups having an invoice to generate, read in SQL
+        so that the groups are not loaded in cache before their chunk. """
+        self.recompute()
+        self.env.cr.execute("""
+            SELECT id FROM recurring_contract_group
+            WHERE id = ANY(%s) AND next_invoice_date IS NOT NULL
+            ORDER BY id
+        """, (self.ids,))
+        return [row[0] for row in self.env.cr.fetchall()]
+
+    @api.multi
+    def _generate_chunk_invoices(self, journal, invoicer, shard, stats):
+        """ Generate the invoices of a chunk of groups and validate them
+        all at once. If it fails, the groups are generated again one by one
+        so that only the faulty groups are rolled back. Their failure is
+        recorded on the invoicer.
+        :param stats: GenerationStats collecting the metrics of the job
+        :return: recurring.contract.group recordset of failed groups
+        """
+        with stats.measure('setup'):
+            groups = self._lock_groups()
+            if groups != self:
+                logger.info(
+                    'contract groups {0} skipped: they are generated by '
+                    'another job'.format((self - groups).ids))
+            # Prefetch contract lines and products of the whole chunk
+            groups.mapped('contract_ids').with_context(
+                journal_id=journal.id, type='out_invoice'
+            )._cache_products_inv_data()
+
+        if not groups:
+            return groups
+        error = groups._try_generate_invoices(journal, invoicer, stats)
+        if error is None:
+            return self.browse()
+        errors = [(groups, error)]
+        if len(groups) > 1:
+            # Generate the groups one by one to isolate the failure
+            errors = [
+                (group, group._try_generate_invoices(
+                    journal, invoicer, stats))
+                for group in groups
+            ]
+        failed_groups = self.browse()
+        for group, error in errors:
+            if error is not None:
+                group._register_failure(invoicer, shard, error)
+                failed_groups |= group
+        return failed_groups
+
+    @api.multi
+    def _try_generate_invoices(self, journal, invoicer, stats):
+        """ Generate and validate the invoices of the groups inside a
+        savepoint. If it fails, only the work of these groups is rolled back
+        and the cache of the other records is kept.
+        Concurrency errors are raised again, so that queue_job retries the
+        job: they are not caused by the groups.
+        :return: the traceback of the error or None if the generation
+                 succeeded
+        """
+        invoices = self.env['account.invoice']
+        group_times = list()
+        try:
+            with self.env.cr.savepoint():
+                for contract_group in self:
+                    start = time.time()
+                    invoices |= contract_group._create_invoices(
+                        journal, invoicer, stats)
+                    group_times.append(time.time() - start)
+                validate_start = time.time()
+                with stats.measure('validate'):
+                    empty_invoices = invoices.filtered(
+                        lambda i: not i.invoice_line_ids)
+                    empty_invoices.unlink()
+                    invoices -= empty_invoices
+                    invoices.action_invoice_open()
+        except Exception as error:
+            if isinstance(error, OperationalError) and \
+                    error.pgcode in PG_CONCURRENCY_ERRORS_TO_RETRY:
+                raise
+            # Discard pending recomputations of rolled back records
+            self.env.all.todo.clear()
+            self._invalidate_generation_cache(invoicer)
+            logger.error(
+                'contract groups {0} failed during invoice generation'.
+                format(self.ids), exc_info=True)
+            return ustr(traceback.format_exc())
+        validate_share = (time.time() - validate_start) / (
+            len(group_times) or 1)
+        stats.add_groups([t + validate_share for t in group_times], invoices)
+        return None
+
+    @contextmanager
+    def _lock_invoice_posting(self, journal, stats):
+        """ Generate a chunk while no other job generates invoices in the
+        journal. Its sequence has no gap: concurrent jobs would fail to
+        lock it, or get a serialization error once the other job committed.
+        The advisory lock is taken with another cursor before the
+        transaction of the chunk starts, so that the snapshot of the chunk
+        is taken once the other jobs committed their invoices. The chunk
+        must be committed before the lock is released: its groups are
+        generated and validated in one transaction.
+        """
+        with self.env.registry.cursor() as lock_cr:
+            with stats.measure('lock'):
+                lock_cr.execute("SELECT pg_advisory_xact_lock(%s, %s)", (
+                    POSTING_LOCK_KEY, journal.sequence_id.id))
+            if not test_mode:
+                # Values read since the last commit come from a snapshot
+                # taken before the lock: start a new one.
+                self.env.cr.commit()    # pylint: disable=invalid-commit
+            yield
+
+    @api.multi
+    def _invalidate_generation_cache(self, invoicer):
+        """ Forget the cached values of the records handled by the
+        generation of the groups: after a rollback to a savepoint, or to
+        release the memory once a chunk is done. Values of other records
+        (products, accounts, journals...) stay in cache. """
+        for model in ('account.invoice', 'account.invoice.line',
+                      'account.move', 'account.move.line', 'mail.message',
+                      'mail.followers', 'ir.sequence',
+                      'ir.sequence.date_range'):
+            model_obj = self.env[model]
+            model_obj.invalidate_cache(fnames=list(model_obj._fields))
+        contracts = self.mapped('contract_ids')
+        partners = self.mapped('partner_id') | contracts.mapped('partner_id')
+        contract_lines = contracts.mapped('contract_line_ids')
+        self.invalidate_cache(ids=self.ids)
+        contracts.invalidate_cache(ids=contracts.ids)
+        contract_lines.invalidate_cache(ids=contract_lines.ids)
+        partners.invalidate_cache(ids=partners.ids)
+        invoicer.invalidate_cache(ids=invoicer.ids)
+
+    @api.multi
+    def _register_failure(self, invoicer, shard, error_traceback):
+        """ Record that the generation of the group failed.
+        :param error_traceback: formatted traceback of the error
+        """
+        self.ensure_one()
+        # The last line of the traceback holds the error message
+        lines = filter(None, error_traceback.strip().splitlines())
+        return self.env['recurring.invoicer.failure'].create({
+            'invoicer_id': invoicer.id,
+            'shard_id': shard.id,
+            'group_id': self.id,
+            'error': lines and lines[-1],
+            'traceback': error_traceback,
+        })
+
+    @api.multi
+    def _lock_groups(self, attempts=3):
+        """ Lock the groups until the end of the transaction, so that no
+        other job can generate their invoices at the same time. Groups
+        already locked by another transaction are skipped, without waiting.
+        The cache of the locked groups and their contracts is refreshed,
+        as another job may have generated them in the meantime.
+        It must be called at the start of a transaction: if another job
+        commits a group after the snapshot is taken, the transaction is
+        rolled back and the lock is tried again.
+        :param attempts: number of tries left in case of concurrent update
+        :return: recurring.contract.group recordset of locked groups
+        """
+        if not self:
+            return self
+        try:
+            self.env.cr.execute("""
+                SELECT id FROM recurring_contract_group
+                WHERE id = ANY(%s)
+                FOR UPDATE SKIP LOCKED
+            """, [self.ids])
+        except OperationalError as error:
+            if test_mode or attempts <= 1 or \
+                    error.pgcode not in PG_CONCURRENCY_ERRORS_TO_RETRY:
+                raise
+            # Nothing is pending since the last commit
+            self.env.cr.rollback()
+            return self._lock_groups(attempts - 1)
+        locked_ids = set(row[0] for row in self.env.cr.fetchall())
+        groups = self.filtered(lambda g: g.id in locked_ids)
+        groups.invalidate_cache(ids=groups.ids)
+        contracts = groups.mapped('contract_ids')
+        contracts.invalidate_cache(ids=contracts.ids)
+        return groups
+
+    def _create_invoices(self, journal, invoicer, stats=None):
+        """ Create the draft invoices of the group, up to its advance
+        billing limit, and advance the next invoice date of its contracts.
+        :param stats: GenerationStats collecting the metrics of the job
+        :return: account.invoice recordset
+        """
+        self.ensure_one()
+        if stats is None:
+            stats = GenerationStats()
+        inv_obj = self.env['account.invoice']
+        invoices = inv_obj
+        month_delta = self.advance_billing_months or 1
+        limit_date = datetime.today() + relativedelta(months=+month_delta)
+        current_date = fields.Datetime.from_string(self.next_invoice_date)
+        while current_date <= limit_date:
+            contracts = self._get_contracts_to_invoice(current_date)
+            if not contracts:
+                break
+            with stats.measure('create'):
+                inv_data = self._setup_inv_data(journal, invoicer, contracts)
+                invoices |= inv_obj.create(inv_data)
+            if not self.env.context.get('no_next_date_update'):
+                with stats.measure('next_date'):
+                    contracts.update_next_invoice_date()
+            current_date += self.get_relative_delta()
+        return invoices
+
+    def _get_contracts_to_invoice(self, current_date):
+        """ Contracts of the group that must be invoiced at given date.
+        :param current_date: datetime of the invoicing period
+        :return: recurring.contract recordset
+        """
+        self.ensure_one()
+        gen_states = self._get_gen_states()
+        return self.contract_ids.filtered(
+            lambda c: c.next_invoice_date and
+            fields.Datetime.from_string(
+                c.next_invoice_date) <= current_date and
+            c.state in gen_states and not (
+                c.end_date and c.end_date >= c.next_invoice_date)
+        )
+
     @api.multi
     @job(default_channel='root.recurring_invoicer')
     def _clean_generate_invoices(self):
@@ -11,6 +11,7 @@
 
 import logging
 
+from collections import defaultdict
 from datetime import datetime
 
 import odoo.addons.decimal_precision as dp
@@ -83,7 +84,7 @@ class RecurringContract(models.Model):
         readonly=False, states={'draft': [('readonly', False)]},
         track_visibility="onchange")
     last_paid_invoice_date = fields.Date(
-        compute='_compute_last_paid_invoice')
+        compute='_compute_last_paid_invoice', store=True, index=True)
     partner_id = fields.Many2one(
         'res.partner', 'Partner', required=True, readonly=True,
         states={'draft': [('readonly', False)]}, ondelete='restrict')
@@ -106,7 +107,7 @@ class RecurringContract(models.Model):
     payment_mode_id = fields.Many2one(
         'account.payment.mode', string='Payment mode',
         related='group_id.payment_mode_id', readonly=True, store=True)
-    nb_invoices = fields.Integer(compute='_compute_invoices')
+    nb_invoices = fields.Integer(compute='_compute_invoices', store=True)
 
     _sql_constraints = [
         ('unique_ref', "unique(reference)", "Reference must be unique!")
@@ -131,22 +132,66 @@ class RecurringContract(models.Model):
                 line.subtotal for line in contract.contract_line_ids
             ])
 
+    @api.depends('invoice_line_ids.state',
+                 'invoice_line_ids.invoice_id.date_invoice')
     def _compute_last_paid_invoice(self):
-        for contract in self:
+        """ The dates of saved contracts are computed with one grouped
+        query. The state is read on the invoices: the related state of
+        their lines may not be recomputed yet in database. """
+        stored_contracts = self.filtered('id')
+        paid_dates = dict()
+        if stored_contracts:
+            self.env.cr.execute("""
+                SELECT l.contract_id, MAX(i.date_invoice)
+                FROM account_invoice_line l
+                JOIN account_invoice i ON i.id = l.invoice_id
+                WHERE l.contract_id = ANY(%s) AND i.state = 'paid'
+                GROUP BY l.contract_id
+            """, [stored_contracts.ids])
+            paid_dates = dict(self.env.cr.fetchall())
+        for contract in stored_contracts:
+            contract.last_paid_invoice_date = fields.Date.to_string(
+                paid_dates.get(contract.id)) or False
+        for contract in self - stored_contracts:
             contract.last_paid_invoice_date = max(
                 [invl.invoice_id.date_invoice for invl in
                  contract.invoice_line_ids if invl.state == 'paid'] or [False])
 
+    @api.depends('invoice_line_ids.state', 'invoice_line_ids.invoice_id')
     def _compute_invoices(self):
-        for contract in self:
-            contract.nb_invoices = len(
-                contract.mapped('invoice_line_ids.invoice_id').filtered(
-                    lambda i: i.state not in ('cancel', 'draft')
-                ))
+        """ Counted with one grouped query, as _compute_last_paid_invoice.
+        """
+        stored_contracts = self.filtered('id')
+        nb_invoices = dict()
+        if stored_contracts:
+            self.env.cr.execute("""
+                SELECT l.contract_id, COUNT(DISTINCT l.invoice_id)
+                FROM account_invoice_line l
+                JOIN account_invoice i ON i.id = l.invoice_id
+                WHERE l.contract_id = ANY(%s)
+                AND i.state NOT IN ('cancel', 'draft')
+                GROUP BY l.contract_id
+            """, [stored_contracts.ids])
+            nb_invoices = dict(self.env.cr.fetchall())
+        for contract in stored_contracts:
+            contract.nb_invoices = nb_invoices.get(contract.id, 0)
+        for contract in self - stored_contracts:
+            contract.nb_invoices = len(set(
+                line.invoice_id.id for line in contract.invoice_line_ids
+                if line.state not in ('cancel', 'draft')
+            ))
 
     ##########################################################################
     #                              ORM METHODS                               #
     ##########################################################################
+    @api.model_cr
+    def init(self):
+        """ Index used to compute the next invoice date of groups. """
+        self.env.cr.execute("""
+            CREATE INDEX IF NOT EXISTS
+            recurring_contract_group_next_invoice_date_index
+            ON recurring_contract (group_id, next_invoice_date)
+        """)
 
     @api.model
     def create(self, vals):
@@ -165,7 +210,8 @@ class RecurringContract(models.Model):
 
         res = super(RecurringContract, self).write(vals)
 
-        if 'contract_line_ids' in vals:
+        if 'contract_line_ids' in vals and not self.env.context.get(
+                'defer_invoice_update'):
             self._on_contract_lines_changed()
 
         return res
@@ -202,6 +248,47 @@ class RecurringContract(models.Model):
     ##########################################################################
     #                             PUBLIC METHODS                             #
     ##########################################################################
+    @api.model
+    def update_contract_lines(self, lines_commands):
+        """ Mass update of contract lines, for instance to change the price
+        of many contracts. The amounts of the contracts are recomputed
+        together and their open invoices are updated once at the end,
+        instead of once per contract. The changes of total amount are
+        tracked in the messages of each contract.
+        :param lines_commands: dict {contract_id: contract_line_ids commands}
+        :return: True
+        """
+        contracts = self.browse(lines_commands.keys())
+        tracked_fields = contracts._get_tracked_fields(['total_amount'])
+        initial_values = {
+            contract.id: {name: contract[name] for name in tracked_fields}
+            for contract in contracts
+        }
+        for contract in contracts.with_context(
+                defer_invoice_update=True, recompute=False):
+            contract.write({
+                'contract_line_ids': lines_commands[contract.id]})
+        contracts.recompute()
+        contracts.message_track(tracked_fields, initial_values)
+        contracts._on_contract_lines_changed()
+        return True
+
+    @api.model
+    def recompute_all_amounts(self, batch_size=10000):
+        """ Maintenance method recomputing the subtotal of all contract lines
+        and the total amount of all contracts, for instance after a data
+        migration. The amounts are computed in SQL by batches of contracts.
+        """
+        self.env.cr.execute("SELECT id FROM recurring_contract ORDER BY id")
+        contract_ids = [row[0] for row in self.env.cr.fetchall()]
+        for index in range(0, len(contract_ids), batch_size):
+            self.browse(
+                contract_ids[index:index + batch_size])._recompute_amounts()
+            _logger.info("Amounts of contracts {0}/{1} recomputed".format(
+                min(index + batch_size, len(contract_ids)),
+                len(contract_ids)))
+        return True
+
     @api.multi
     def clean_invoices(self, since_date=None, to_date=None, keep_lines=None):
         """ By default, launch asynchronous job to perform the task.
@@ -215,36 +302,75 @@ class RecurringContract(models.Model):
 
     def rewind_next_invoice_date(self):
         """ Rewinds the next invoice date of contract after the last
-        generated invoice. No open invoices exist after that date. """
+        generated invoice. No open invoices exist after that date.
+        The dates of all contracts are found with one grouped query and
+        contracts rewound to the same date are written together. """
         gen_states = self.env['recurring.contract.group']._get_gen_states()
-        for contract in self.with_context(allow_rewind=True):
-            if contract.state in gen_states:
-                last_invoice_date = max([
-                    datetime.strptime(line.invoice_id.date_invoice, DF) for
-                    line in contract.invoice_line_ids
-                    if line.state in ('open', 'paid')] or [False])
-                if last_invoice_date:
-                    contract.write({
-                        'next_invoice_date': last_invoice_date.strftime(DF)})
-                    contract.update_next_invoice_date()
-                else:
-                    # No open/paid invoices, look for cancelled ones
-                    next_invoice_date = min([
-                        datetime.strptime(line.invoice_id.date_invoice, DF)
-                        for line in contract.invoice_line_ids
-                        if line.state == 'cancel'] or [False])
-                    if next_invoice_date:
-                        contract.write({
-                            'next_invoice_date':
-                            next_invoice_date.strftime(DF)})
+        contracts = self.filtered(lambda c: c.state in gen_states)
+        if not contracts:
+            return True
+        # Make sure the state of invoice lines is up to date in database
+        self.recompute()
+        self.env.cr.execute("""
+            SELECT l.contract_id,
+                   MAX(CASE WHEN l.state IN ('open', 'paid')
+                       THEN i.date_invoice END),
+                   MIN(CASE WHEN l.state = 'cancel'
+                       THEN i.date_invoice END)
+            FROM account_invoice_line l
+            JOIN account_invoice i ON i.id = l.invoice_id
+            WHERE l.contract_id = ANY(%s)
+            GROUP BY l.contract_id
+        """, [contracts.ids])
+        rewind_dates = defaultdict(list)
+        to_update_ids = list()
+        for contract_id, last_invoice_date, cancel_date in \
+                self.env.cr.fetchall():
+            if last_invoice_date:
+                rewind_dates[last_invoice_date].append(contract_id)
+                to_update_ids.append(contract_id)
+            elif cancel_date:
+                # No open/paid invoices, take the first cancelled one
+                rewind_dates[cancel_date].append(contract_id)
+
+        contracts = contracts.with_context(allow_rewind=True)
+        for rewind_date, contract_ids in rewind_dates.iteritems():
+            contracts.browse(contract_ids).write({
+                'next_invoice_date': fields.Date.to_string(rewind_date)})
+        contracts.browse(to_update_ids).update_next_invoice_date()
 
         return True
 
     def update_next_invoice_date(self):
-        """ Recompute and set next_invoice date. """
+        """ Recompute and set next_invoice date.
+        Contracts sharing the same recurrence and next invoice date are
+        moved together with a single write. Changes are not tracked in
+        the messages of each contract: one message is posted by batch on
+        each contract group, listing its moved contracts.
+        """
+        batches = dict()
         for contract in self:
-            next_date = contract._compute_next_invoice_date()
-            contract.write({'next_invoice_date': next_date})
+            group = contract.group_id
+            key = (group.recurring_unit, group.recurring_value,
+                   contract.next_invoice_date)
+            batches.setdefault(key, list()).append(contract.id)
+
+        for key, contract_ids in batches.iteritems():
+            contracts = self.browse(contract_ids)
+            next_date = contracts[0]._compute_next_invoice_date()
+            contracts.with_context(tracking_disable=True).write({
+                'next_invoice_date': next_date})
+            for group in contracts.mapped('group_id'):
+                group_contracts = contracts.filtered(
+                    lambda c: c.group_id == group)
+                group.message_post(_(
+                    "Next invoice date moved from {0} to {1} for "
+                    "contracts {2}").format(
+                    key[2], next_date,
+                    ', '.join(group_contracts.mapped('reference'))))
+            _logger.debug(
+                "Next invoice date of {0} contracts moved from {1} to {2}"
+                .format(len(contracts), key[2], next_date))
         return True
 
     @api.multi
@@ -255,17 +381,17 @@ class RecurringContract(models.Model):
         :return: list of dictionaries
         """
         res = list()
-        default_account = self.env['account.invoice.line']._default_account()
+        products_data = self._cache_products_inv_data()
         for contract_line in self.mapped('contract_line_ids'):
             product = contract_line.product_id
+            product_name, account_id = products_data[product.id]
             inv_line_data = {
-                'name': product.name,
+                'name': product_name,
                 'price_unit': contract_line.amount,
                 'quantity': contract_line.quantity,
                 'product_id': product.id,
                 'contract_id': contract_line.contract_id.id,
-                'account_id': product.property_account_income_id.id or
-                default_account
+                'account_id': account_id
             }
             res.append(inv_line_data)
         return res
@@ -328,9 +454,12 @@ class RecurringContract(models.Model):
 
     @api.multi
     def contract_terminated(self):
+        # Contracts already terminated by end_date_reached have their
+        # invoices cleaned in batch by the cron.
+        to_clean = self.filtered(lambda c: c.state != 'terminated')
         today = datetime.today().strftime(DF)
         self.write({'state': 'terminated', 'end_date': today})
-        self.clean_invoices()
+        to_clean.clean_invoices()
         return True
 
     @api.model
@@ -340,13 +469,44 @@ class RecurringContract(models.Model):
                                  ('end_date', '<=', today)])
 
         if contracts:
+            # The context is not given to the workflow actions: the state
+            # is written first so that contract_terminated skips the
+            # cleaning of the invoices.
+            contracts.write({'state': 'terminated', 'end_date': today})
             contracts.signal_workflow('contract_terminated')
+            contracts.clean_invoices_by_group()
 
         return True
 
+    @api.multi
+    def clean_invoices_by_group(self):
+        """ Clean the invoices of the contracts with one job per chunk of
+        contracts instead of one job per contract. The contracts of a
+        group are kept in the same chunk, as they share their invoices.
+        """
+        chunk_size = self._get_clean_chunk_size()
+        contract_ids = defaultdict(list)
+        for contract in self:
+            contract_ids[contract.group_id.id].append(contract.id)
+        chunk_ids = list()
+        for group_id in sorted(contract_ids):
+            chunk_ids.extend(contract_ids[group_id])
+            if len(chunk_ids) >= chunk_size:
+                self.browse(chunk_ids).clean_invoices()
+                chunk_ids = list()
+        if chunk_ids:
+            self.browse(chunk_ids).clean_invoices()
+        return True
+
     ##########################################################################
     #                             PRIVATE METHODS                            #
     ##########################################################################
+    @api.model
+    def _get_clean_chunk_size(self):
+        """ Number of invoices cleaned together, see clean_invoices. """
+        return self.env['recurring.contract.group']._get_generation_param(
+            'clean_chunk_size', 100)
+
     @api.multi
     @job(default_channel='root.recurring_invoicer')
     @related_action(action='related_action_contract')
@@ -355,57 +515,91 @@ class RecurringContract(models.Model):
             having a due date >= current month. If the invoice_line was the
             only line in the invoice, we cancel the invoice. In the other
             case, we have to revalidate the invoice to update the move lines.
+            Invoices are processed by chunks to limit the size of the cache.
         """
         _logger.info("clean invoices called.")
         inv_lines = self._get_invoice_lines_to_clean(since_date, to_date)
         invoices = inv_lines.mapped('invoice_id')
-        empty_invoices = self.env['account.invoice']
-        to_remove_invl = self.env['account.invoice.line']
-
+        lines_by_invoice = defaultdict(list)
         for inv_line in inv_lines:
-            invoice = inv_line.invoice_id
-            # Check if invoice is empty after removing the invoice_lines
-            # of the given contract
-            if invoice not in empty_invoices:
-                remaining_lines = invoice.invoice_line_ids.filtered(
-                    lambda l: not l.contract_id or l.contract_id not in self)
-                if remaining_lines:
-                    # We can move or remove the line
-                    to_remove_invl |= inv_line
-                else:
-                    # The invoice would be empty if we remove the line
-                    empty_invoices |= invoice
-
-        if keep_lines:
-            self._move_cancel_lines(to_remove_invl, keep_lines)
-        else:
-            invoices.action_invoice_cancel()
-            invoices.action_invoice_draft()
-            invoices.env.invalidate_all()
-            to_remove_invl.unlink()
-
-        # Refresh cache before calling workflows
-        self.env.invalidate_all()
-        # Invoices to set back in open state
-        renew_invs = invoices - empty_invoices
-        self._cancel_confirm_invoices(invoices, renew_invs, keep_lines)
+            lines_by_invoice[inv_line.invoice_id.id].append(inv_line.id)
+        # Invoices having no other lines than the ones of the contracts
+        # would be empty: they are simply cancelled.
+        empty_ids = set(invoices.ids) - self._get_invoices_with_other_lines(
+            invoices)
+        chunk_size = self._get_clean_chunk_size()
+
+        for index in range(0, len(invoices), chunk_size):
+            chunk = invoices[index:index + chunk_size]
+            renew_invs = chunk.filtered(lambda i: i.id not in empty_ids)
+            to_remove_invl = inv_lines.browse([
+                line_id for invoice_id in renew_invs.ids
+                for line_id in lines_by_invoice[invoice_id]])
+            if keep_lines:
+                self._move_cancel_lines(to_remove_invl, keep_lines)
+                self._cancel_confirm_invoices(chunk, renew_invs, keep_lines)
+            else:
+                chunk.action_invoice_cancel()
+                renew_invs.action_invoice_draft()
+                to_remove_invl.unlink()
+                # Refresh cache of modified invoices before the workflow
+                renew_invs.invalidate_cache(ids=renew_invs.ids)
+                renew_invs.action_invoice_open()
 
         _logger.info(str(len(invoices)) + " invoices cleaned.")
         return invoices
 
     def _on_contract_lines_changed(self):
         """Update related invoices to reflect the changes to the contract.
+        Invoices are processed by chunks to limit the size of the cache.
         """
         inv_lines = self.env['account.invoice.line'].search(
             [('contract_id', 'in', self.ids),
              ('state', 'not in', ('paid', 'cancel'))])
 
         invoices = inv_lines.mapped('invoice_id')
-        invoices.action_invoice_cancel()
-        invoices.action_invoice_draft()
-        invoices.env.invalidate_all()
-        self._update_invoice_lines(invoices)
-        invoices.action_invoice_open()
+        chunk_size = self._get_clean_chunk_size()
+        for index in range(0, len(invoices), chunk_size):
+            chunk = invoices[index:index + chunk_size]
+            chunk.action_invoice_cancel()
+            chunk.action_invoice_draft()
+            self._update_invoice_lines(chunk)
+            # Refresh cache of modified invoices before the workflow
+            chunk.invalidate_cache(ids=chunk.ids)
+            chunk.action_invoice_open()
+
+    @api.multi
+    def _recompute_amounts(self):
+        """ Recompute the subtotal of the contract lines and the total amount
+        of the contracts with one SQL statement each, instead of going
+        record by record through the ORM. Pending recomputations of these
+        fields are discarded. The changes of total amount are not tracked
+        and fields depending on the amounts are not recomputed: only use it
+        for maintenance, see recompute_all_amounts.
+        """
+        if not self:
+            return True
+        line_obj = self.env['recurring.contract.line']
+        digits = self.env['decimal.precision'].precision_get('Account')
+        self.env.cr.execute("""
+            UPDATE recurring_contract_line
+            SET subtotal = ROUND(CAST(amount * quantity AS numeric), %s)
+            WHERE contract_id = ANY(%s)
+            RETURNING id
+        """, (digits, self.ids))
+        lines = line_obj.browse([row[0] for row in self.env.cr.fetchall()])
+        self.env.cr.execute("""
+            UPDATE recurring_contract c
+            SET total_amount = COALESCE((
+                SELECT SUM(l.subtotal) FROM recurring_contract_line l
+                WHERE l.contract_id = c.id), 0)
+            WHERE c.id = ANY(%s)
+        """, (self.ids,))
+        self.env.remove_todo(line_obj._fields['subtotal'], lines)
+        self.env.remove_todo(self._fields['total_amount'], self)
+        lines.invalidate_cache(['subtotal'], lines.ids)
+        self.invalidate_cache(['total_amount'], self.ids)
+        return True
 
     @api.model
     def _move_cancel_lines(self, invoice_lines, message=None):
@@ -450,9 +644,33 @@ class RecurringContract(models.Model):
                      "\n\tinvoices to confirm : " + str(invoice_confirm.ids))
         invoice_cancel.action_invoice_cancel()
         invoice_confirm.action_invoice_draft()
-        invoice_confirm.env.invalidate_all()
+        invoice_confirm.invalidate_cache(ids=invoice_confirm.ids)
         invoice_confirm.action_invoice_open()
 
+    @api.multi
+    def _cache_products_inv_data(self):
+        """ Get the name and income account of the products sold by the
+        contracts. During an invoice generation, the context holds a cache
+        (key product_inv_data) shared by all contracts, so that product
+        properties are read only once per run.
+        :return: dict {product_id: (name, account_id)}
+        """
+        cache = self.env.context.get('product_inv_data')
+        if cache is None:
+            cache = dict()
+        products = self.mapped('contract_line_ids.product_id').filtered(
+            lambda p: p.id not in cache)
+        if products:
+            default_account = self.env[
+                'account.invoice.line']._default_account()
+            # Income accounts are company dependent: read them in batch
+            for product in products:
+                cache[product.id] = (
+                    product.name,
+                    product.property_account_income_id.id or default_account
+                )
+        return cache
+
     def _compute_next_invoice_date(self):
         """ Compute next_invoice_date for a single contract. """
         next_date = datetime.strptime(self.next_invoice_date, DF)
@@ -462,31 +680,48 @@ class RecurringContract(models.Model):
     def _update_invoice_lines(self, invoices):
         """Update invoice lines generated by a contract, when the contract
         was modified and corresponding invoices were cancelled.
+        The lines of each invoice are replaced with one write, and the
+        payment mode is written once per payment mode.
 
         Parameters:
-            - invoice_ids (list): ids of draft invoices to be
-                                  updated and validated
+            - invoices (account.invoice): draft invoices to be
+                                          updated and validated
         """
-        for contract in self:
-            # Update payment term
-            invoices.write({
-                'payment_mode_id': contract.payment_mode_id.id
+        contract_ids = set(self.ids)
+        old_line_ids = list()
+        contracts_by_invoice = list()
+        invoice_ids_by_mode = defaultdict(list)
+        for invoice in invoices:
+            invoice_lines = invoice.invoice_line_ids.filtered(
+                lambda line: line.contract_id.id in contract_ids)
+            contracts = invoice_lines.mapped('contract_id')
+            if contracts:
+                old_line_ids.extend(invoice_lines.ids)
+                contracts_by_invoice.append((invoice, contracts))
+                invoice_ids_by_mode[
+                    contracts[-1].payment_mode_id.id].append(invoice.id)
+        self.env['account.invoice.line'].browse(old_line_ids).unlink()
+
+        # Product data is cached per journal, as the default account is
+        # taken from the journal.
+        products_data = defaultdict(dict)
+        for invoice, contracts in contracts_by_invoice:
+            journal = invoice.journal_id
+            invl = [(0, 0, l) for l in contracts.with_context(
+                journal_id=journal.id,
+                product_inv_data=products_data[journal.id]
+            ).get_inv_lines_data() if l]
+            invoice.write({'invoice_line_ids': invl})
+
+        # Update payment mode
+        for payment_mode_id, invoice_ids in invoice_ids_by_mode.iteritems():
+            invoices.browse(invoice_ids).write({
+                'payment_mode_id': payment_mode_id
             })
 
-            for invoice in invoices:
-                # Generate new invoice_lines
-                old_lines = invoice.invoice_line_ids.filtered(
-                    lambda line: line.contract_id.id == contract.id)
-                old_lines.unlink()
-                journal = invoice.journal_id
-                invl = [(0, 0, l) for l in
-                        contract.with_context(
-                            journal_id=journal.id).get_inv_lines_data() if l]
-                invoice.write({'invoice_line_ids': invl})
-
     def _on_change_next_invoice_date(self, new_invoice_date):
+        new_invoice_date = datetime.strptime(new_invoice_date, DF)
         for contract in self:
-            new_invoice_date = datetime.strptime(new_invoice_date, DF)
             if contract.next_invoice_date:
                 next_invoice_date = datetime.strptime(
                     contract.next_invoice_date, DF)
@@ -496,6 +731,21 @@ class RecurringContract(models.Model):
                         _('You cannot rewind the next invoice date.'))
         return True
 
+    def _get_invoices_with_other_lines(self, invoices):
+        """ Find which invoices contain lines that don't belong to the
+        contracts.
+        :param invoices: account.invoice recordset
+        :return: set of invoice ids
+        """
+        if not invoices:
+            return set()
+        self.env.cr.execute("""
+            SELECT DISTINCT invoice_id FROM account_invoice_line
+            WHERE invoice_id = ANY(%s)
+            AND (contract_id IS NULL OR contract_id != ALL(%s))
+        """, [invoices.ids, self.ids])
+        return set(row[0] for row in self.env.cr.fetchall())
+
     def _get_invoice_lines_to_clean(self, since_date, to_date):
         """ Find all unpaid invoice lines in the given period. """
         invl_search = [('contract_id', 'in', self.ids),
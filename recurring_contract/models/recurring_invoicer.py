@@ -12,11 +12,18 @@
 from datetime import datetime
 
 from odoo import api, fields, models, _
-from odoo.tools import DEFAULT_SERVER_DATE_FORMAT as DF
+from odoo.tools import config, DEFAULT_SERVER_DATE_FORMAT as DF
+
+from odoo.addons.queue_job.exception import RetryableJobError
+from odoo.addons.queue_job.job import job, related_action
 
 import logging
 
 logger = logging.getLogger(__name__)
+test_mode = config.get('test_enable')
+
+# Delay in seconds before the next try of failed groups, by number of tries
+RETRY_PATTERN = {1: 60, 2: 120, 3: 240, 4: 480, 5: 960}
 
 
 class RecurringInvoicer(models.Model):
@@ -35,10 +42,83 @@ class RecurringInvoicer(models.Model):
     invoice_ids = fields.One2many(
         'account.invoice', 'recurring_invoicer_id',
         'Generated invoices')
+    shard_ids = fields.One2many(
+        'recurring.invoicer.shard', 'invoicer_id', 'Generation jobs',
+        readonly=True)
+    failure_ids = fields.One2many(
+        'recurring.invoicer.failure', 'invoicer_id', 'Failed groups',
+        readonly=True)
+    state = fields.Selection([
+        ('pending', _('Pending')),
+        ('running', _('Running')),
+        ('done', _('Done')),
+    ], compute='_compute_progress')
+    progress = fields.Float(compute='_compute_progress')
+    nb_invoices = fields.Integer('Invoices', compute='_compute_metrics')
+    nb_invoice_lines = fields.Integer(
+        'Invoice lines', compute='_compute_metrics')
+    nb_failures = fields.Integer(
+        'Failed groups', compute='_compute_metrics',
+        help='Contract groups whose generation still fails.')
+    duration = fields.Float(
+        'Duration', compute='_compute_metrics',
+        help='Wall time in seconds from the start of the first job to the '
+             'end of the last one.')
+
+    @api.depends('shard_ids.state', 'shard_ids.nb_groups',
+                 'shard_ids.nb_groups_done')
+    def _compute_progress(self):
+        for invoicer in self:
+            shards = invoicer.shard_ids
+            nb_groups = sum(shards.mapped('nb_groups'))
+            nb_done = sum(shards.mapped('nb_groups_done'))
+            invoicer.progress = nb_groups and 100.0 * nb_done / nb_groups
+            states = set(shards.mapped('state'))
+            if not states or states == {'pending'}:
+                invoicer.state = 'pending'
+            elif states == {'done'}:
+                invoicer.state = 'done'
+            else:
+                invoicer.state = 'running'
+
+    @api.depends('shard_ids.nb_invoices', 'shard_ids.nb_invoice_lines',
+                 'shard_ids.date_start', 'shard_ids.date_done',
+                 'failure_ids.group_id')
+    def _compute_metrics(self):
+        """ Metrics are stored on the shards, as their jobs run
+        concurrently. The invoicer shows the totals. Retries add shards:
+        failed groups are counted from the failures that remain. """
+        for invoicer in self:
+            shards = invoicer.shard_ids
+            invoicer.nb_invoices = sum(shards.mapped('nb_invoices'))
+            invoicer.nb_invoice_lines = sum(shards.mapped('nb_invoice_lines'))
+            invoicer.nb_failures = len(invoicer.failure_ids.mapped(
+                'group_id'))
+            starts = filter(None, shards.mapped('date_start'))
+            ends = filter(None, shards.mapped('date_done'))
+            invoicer.duration = 0.0
+            if starts and ends:
+                invoicer.duration = (
+                    fields.Datetime.from_string(max(ends)) -
+                    fields.Datetime.from_string(min(starts))
+                ).total_seconds()
 
     def calculate_id(self):
         return self.env['ir.sequence'].next_by_code('rec.invoicer.ident')
 
+    @api.multi
+    def add_shard(self, groups):
+        """ Register a new generation job for the given contract groups.
+        :param groups: recurring.contract.group recordset of the shard
+        :return: recurring.invoicer.shard record
+        """
+        self.ensure_one()
+        return self.env['recurring.invoicer.shard'].create({
+            'invoicer_id': self.id,
+            'sequence': len(self.shard_ids) + 1,
+            'nb_groups': len(groups),
+        })
+
     @api.multi
     def cancel_invoices(self):
         """
@@ -52,6 +132,38 @@ class RecurringInvoicer(models.Model):
 
         return True
 
+    @api.multi
+    def retry_failed_groups(self):
+        """ Launch a job generating again the invoices of the groups that
+        failed. The job is retried with an increasing delay while some
+        groups still fail.
+        :return: True
+        """
+        for invoicer in self.filtered('failure_ids'):
+            invoicer.with_delay()._retry_failed_groups()
+        return True
+
+    @api.multi
+    @job(default_channel='root.recurring_invoicer',
+         retry_pattern=RETRY_PATTERN)
+    @related_action(action='related_action_invoicer')
+    def _retry_failed_groups(self):
+        """ Generate again the invoices of the failed groups. Failures that
+        happen again are recorded and the job is retried later. """
+        self.ensure_one()
+        failures = self.failure_ids
+        groups = failures.mapped('group_id')
+        failures.unlink()
+        groups._generate_invoices(self)
+        if self.failure_ids:
+            if not test_mode:
+                # Keep the invoices of the groups that succeeded
+                self.env.cr.commit()    # pylint: disable=invalid-commit
+            raise RetryableJobError(
+                '{0} contract groups failed again'.format(
+                    len(self.failure_ids)), ignore_retry=False)
+        return True
+
     @api.multi
     def show_invoices(self):
         return {
@@ -68,3 +180,81 @@ class RecurringInvoicer(models.Model):
             'target': 'current',
             'context': self.env.context,
         }
+
+
+class RecurringInvoicerShard(models.Model):
+    """ A shard is a disjoint subset of contract groups for which invoices
+    are generated by one job of the invoicer. Each job writes only on its
+    own shard, so that concurrent jobs never update the same row.
+    """
+    _name = 'recurring.invoicer.shard'
+    _description = 'Invoice generation job'
+    _order = 'invoicer_id, sequence'
+
+    invoicer_id = fields.Many2one(
+        'recurring.invoicer', 'Invoicer', required=True, ondelete='cascade',
+        index=True)
+    sequence = fields.Integer('Shard', required=True)
+    state = fields.Selection([
+        ('pending', _('Pending')),
+        ('running', _('Running')),
+        ('done', _('Done')),
+    ], default='pending', required=True)
+    nb_groups = fields.Integer('Contract groups')
+    nb_groups_done = fields.Integer('Processed groups')
+    date_start = fields.Datetime('Started')
+    date_done = fields.Datetime('Finished')
+    # Metrics of the generation, times are in seconds
+    nb_invoices = fields.Integer('Invoices')
+    nb_invoice_lines = fields.Integer('Invoice lines')
+    nb_failures = fields.Integer('Failed groups')
+    time_setup = fields.Float('Setup time')
+    time_create = fields.Float('Creation time')
+    time_validate = fields.Float('Validation time')
+    time_next_date = fields.Float('Next date update time')
+    time_commit = fields.Float('Commit time')
+    time_lock = fields.Float(
+        'Posting lock wait time',
+        help='Time spent waiting for other jobs to validate their invoices')
+    time_group_p50 = fields.Float('Median time per group')
+    time_group_p95 = fields.Float('95th percentile time per group')
+    memory_peak = fields.Integer(
+        'Memory peak (MB)',
+        help='Memory high-water mark of the worker process running the job')
+
+    @api.multi
+    def start(self):
+        self.write({
+            'state': 'running',
+            'date_start': fields.Datetime.now(),
+            'nb_groups_done': 0,
+        })
+        return True
+
+    @api.multi
+    def finish(self):
+        self.write({
+            'state': 'done',
+            'date_done': fields.Datetime.now(),
+        })
+        return True
+
+
+class RecurringInvoicerFailure(models.Model):
+    """ A contract group for which the invoice generation failed. Its work
+    was rolled back and can be done again. """
+    _name = 'recurring.invoicer.failure'
+    _description = 'Invoice generation failure'
+    _order = 'invoicer_id, id'
+
+    invoicer_id = fields.Many2one(
+        'recurring.invoicer', 'Invoicer', required=True, ondelete='cascade',
+        index=True)
+    shard_id = fields.Many2one(
+        'recurring.invoicer.shard', 'Generation job', ondelete='cascade')
+    group_id = fields.Many2one(
+        'recurring.contract.group', 'Contract group', required=True,
+        ondelete='cascade')
+    partner_id = fields.Many2one(related='group_id.partner_id', readonly=True)
+    error = fields.Char()
+    traceback = fields.Text()
@@ -10,3 +10,4 @@
 ##############################################################################
 
 from . import test_recurring_contract
+from . import test_benchmark
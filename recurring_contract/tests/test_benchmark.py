@@ -0,0 +1,130 @@
+# -*- coding: utf-8 -*-
+##############################################################################
+#
+#    Copyright (C) 2018 Compassion CH (http://www.compassion.ch)
+#    Releasing children from poverty in Jesus' name
+#
+#    The licence is in the file __manifest__.py
+#
+##############################################################################
+"""
+Benchmark of the invoicing of recurring contracts.
+
+The benchmark is skipped unless the environment variable
+RECURRING_CONTRACT_BENCHMARK gives the numbers of contracts to generate,
+for instance:
+
+    RECURRING_CONTRACT_BENCHMARK=1000,10000 odoo -d bench \\
+        -i recurring_contract --test-enable --stop-after-init
+
+For each scale, the number of seconds and SQL queries of each operation
+is logged.
+"""
+import logging
+import os
+import random
+import time
+import unittest
+from contextlib import contextmanager
+
+from .test_recurring_contract import BaseContractTest
+
+logger = logging.getLogger(__name__)
+
+SCALES = [int(scale) for scale in os.environ.get(
+    'RECURRING_CONTRACT_BENCHMARK', '').split(',') if scale.strip()]
+
+
+@unittest.skipUnless(SCALES, 'Set RECURRING_CONTRACT_BENCHMARK to run it.')
+class TestRecurringContractBenchmark(BaseContractTest):
+
+    # (recurring_unit, recurring_value, advance_billing_months, weight)
+    RECURRENCES = [
+        ('month', 1, 1, 70),
+        ('month', 3, 3, 15),
+        ('month', 6, 6, 5),
+        ('year', 1, 12, 10),
+    ]
+
+    def setUp(self):
+        super(TestRecurringContractBenchmark, self).setUp()
+        self.random = random.Random(42)
+        self.products = self.env['product.product'].search(
+            [('sale_ok', '=', True)], limit=10)
+        self.results = list()
+
+    def test_benchmark(self):
+        for scale in SCALES:
+            groups = self.generate_data(scale)
+            contracts = groups.mapped('contract_ids')
+            with self.benchmark('_generate_invoices', scale):
+                groups._generate_invoices()
+            with self.benchmark('_on_contract_lines_changed', scale):
+                contracts._on_contract_lines_changed()
+            with self.benchmark('rewind_next_invoice_date', scale):
+                contracts.rewind_next_invoice_date()
+            with self.benchmark('_clean_generate_invoices', scale):
+                groups._clean_generate_invoices()
+        self.report()
+
+    def generate_data(self, nb_contracts):
+        """ Create partners with one payment group each, holding one to
+        three contracts of one or two lines.
+        :return: recurring.contract.group recordset
+        """
+        start = time.time()
+        recurrences = [
+            rec[:3] for rec in self.RECURRENCES for i in range(rec[3])]
+        groups = self.group_obj
+        count = 0
+        while count < nb_contracts:
+            partner = self.env['res.partner'].create({
+                'name': 'Benchmark partner %d' % count,
+                'customer': True,
+            })
+            unit, value, advance = self.random.choice(recurrences)
+            group = self.create_group({
+                'partner_id': partner.id,
+                'recurring_unit': unit,
+                'recurring_value': value,
+                'advance_billing_months': advance,
+            })
+            groups |= group
+            for i in range(min(self.random.randint(1, 3),
+                               nb_contracts - count)):
+                lines = [{
+                    'product_id': self.random.choice(self.products).id,
+                    'amount': self.random.choice([30.0, 42.0, 50.0]),
+                } for j in range(self.random.randint(1, 2))]
+                contract = self.create_contract({
+                    'partner_id': partner.id,
+                    'group_id': group.id,
+                }, lines)
+                contract.signal_workflow('contract_validated')
+                count += 1
+        logger.info("Benchmark data for %d contracts created in %.1f s",
+                    nb_contracts, time.time() - start)
+        return groups
+
+    @contextmanager
+    def benchmark(self, operation, scale):
+        """ Measure the time and number of queries of the operation. """
+        self.env.invalidate_all()
+        nb_queries = self.cr.sql_log_count
+        start = time.time()
+        yield
+        duration = time.time() - start
+        nb_queries = self.cr.sql_log_count - nb_queries
+        self.results.append((operation, scale, duration, nb_queries))
+        logger.info("%s on %d contracts: %.2f s, %d queries",
+                    operation, scale, duration, nb_queries)
+
+    def report(self):
+        lines = ["%-30s %10s %10s %10s %16s" % (
+            'Operation', 'Contracts', 'Seconds', 'Queries',
+            'Queries/contract')]
+        for operation, scale, duration, nb_queries in self.results:
+            lines.append("%-30s %10d %10.2f %10d %16.1f" % (
+                operation, scale, duration, nb_queries,
+                float(nb_queries) / scale))
+        logger.info("Recurring contract benchmark\n" + "\n".join(lines))
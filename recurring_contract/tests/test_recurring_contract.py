@@ -9,9 +9,17 @@
 #
 ##############################################################################
 
-from odoo import fields
+from dateutil.relativedelta import relativedelta
+
+from odoo import api, fields
+from odoo.exceptions import UserError
 from odoo.tests.common import TransactionCase
+from odoo.addons.queue_job.exception import RetryableJobError
+from odoo.addons.recurring_contract.models import \
+    contract_group as contract_group_module
+import itertools
 import logging
+import mock
 import random
 import string
 logger = logging.getLogger(__name__)
@@ -111,6 +119,7 @@ class TestRecurringContract(BaseContractTest):
         nb_invoice = len(invoices)
         # 2 invoices must be generated with our parameters
         self.assertEqual(nb_invoice, 2)
+        self.assertEqual(contract.nb_invoices, 2)
         invoice = invoices[1]
         self.assertEqual(original_product, invoice.invoice_line_ids[0].name)
         self.assertEqual(original_partner, invoice.partner_id['name'])
@@ -257,3 +266,514 @@ class TestRecurringContract(BaseContractTest):
             original_price - contract3.total_amount,
             invoice.amount_total)
         self.assertEqual(original_start_date, invoice2.date_invoice)
+
+    def test_end_date_reached(self):
+        """
+            Contracts reaching their end date are terminated and the
+            invoices of a contract group are cleaned by a single job.
+        """
+        group = self.create_group({'partner_id': self.michel.id})
+        contracts = self.con_obj
+        for amount in (10.0, 20.0):
+            contracts |= self.create_contract(
+                {
+                    'partner_id': self.michel.id,
+                    'group_id': group.id,
+                },
+                [{'amount': amount}]
+            )
+        contracts.signal_workflow('contract_validated')
+        invoicer = group.generate_invoices()
+        self.assertTrue(invoicer.invoice_ids)
+        job_obj = self.env['queue.job']
+        job_domain = [('func_string', 'like', '_clean_invoices')]
+        nb_jobs = job_obj.search_count(job_domain)
+
+        contracts.write({'end_date': fields.Date.today()})
+        self.con_obj.with_context(async_mode=True).end_date_reached()
+        self.assertEqual(contracts.mapped('state'), ['terminated'] * 2)
+        self.assertEqual(job_obj.search_count(job_domain), nb_jobs + 1)
+
+    def test_clean_invoices_by_chunks(self):
+        """
+            Invoices cleaned in different chunks are still cancelled when
+            they would be empty, and renewed when they contain lines of
+            other contracts.
+        """
+        self.env['ir.config_parameter'].set_param(
+            'recurring_contract.clean_chunk_size', '1')
+        group = self.create_group({'partner_id': self.michel.id})
+        group2 = self.create_group({'partner_id': self.thomas.id})
+        contracts = self.con_obj
+        for amount in (10.0, 20.0):
+            contracts |= self.create_contract(
+                {'partner_id': self.michel.id, 'group_id': group.id},
+                [{'amount': amount}])
+        contracts |= self.create_contract(
+            {'partner_id': self.thomas.id, 'group_id': group2.id},
+            [{'amount': 30.0}])
+        contracts.signal_workflow('contract_validated')
+        shared_invoice = group.generate_invoices().invoice_ids
+        single_invoice = group2.generate_invoices().invoice_ids
+        self.assertEqual(len(shared_invoice), 1)
+        self.assertEqual(len(single_invoice), 1)
+
+        (contracts[0] + contracts[2])._clean_invoices()
+        self.assertEqual(shared_invoice.state, 'open')
+        self.assertEqual(
+            shared_invoice.mapped('invoice_line_ids.contract_id'),
+            contracts[1])
+        self.assertEqual(shared_invoice.amount_untaxed, 20.0)
+        self.assertEqual(single_invoice.state, 'cancel')
+
+    def test_update_contract_lines(self):
+        """
+            Lines of several contracts are changed at once and their open
+            invoices are updated accordingly.
+        """
+        group = self.create_group({'partner_id': self.michel.id})
+        contracts = self.con_obj
+        for amount in (10.0, 20.0):
+            contracts |= self.create_contract(
+                {
+                    'partner_id': self.michel.id,
+                    'group_id': group.id,
+                },
+                [{'amount': amount}]
+            )
+        contracts.signal_workflow('contract_validated')
+        invoices = group.generate_invoices().invoice_ids
+        self.assertEqual(invoices.mapped('amount_total'), [30.0] * 2)
+        nb_messages = len(contracts.mapped('message_ids'))
+
+        self.con_obj.update_contract_lines({
+            contract.id: [(1, contract.contract_line_ids.id, {
+                'amount': contract.contract_line_ids.amount + 5.0})]
+            for contract in contracts
+        })
+        self.assertEqual(sum(contracts.mapped('total_amount')), 40.0)
+        self.assertEqual(invoices.mapped('state'), ['open'] * 2)
+        self.assertEqual(invoices.mapped('amount_total'), [40.0] * 2)
+        self.assertEqual(
+            len(invoices.mapped('invoice_line_ids')), 4)
+        # The change of total amount is tracked on each contract
+        contracts.invalidate_cache(['message_ids'], contracts.ids)
+        self.assertEqual(
+            len(contracts.mapped('message_ids')), nb_messages + 2)
+        tracking = contracts[0].message_ids[0].tracking_value_ids
+        self.assertEqual(tracking.field, 'total_amount')
+        self.assertEqual(tracking.old_value_float, 10.0)
+        self.assertEqual(tracking.new_value_float, 15.0)
+
+    def test_recompute_amounts(self):
+        """
+            Amounts of contracts changed directly in database are fixed by
+            the maintenance method.
+        """
+        group = self.create_group({'partner_id': self.michel.id})
+        contract = self.create_contract(
+            {
+                'partner_id': self.michel.id,
+                'group_id': group.id,
+            },
+            [{'amount': 10.0, 'quantity': 2}, {'amount': 15.0}]
+        )
+        self.assertEqual(contract.total_amount, 35.0)
+        self.env.cr.execute("""
+            UPDATE recurring_contract_line SET amount = amount * 2
+            WHERE contract_id = %s
+        """, [contract.id])
+        self.con_obj.recompute_all_amounts(batch_size=1)
+        self.assertEqual(
+            contract.contract_line_ids.mapped('subtotal'), [40.0, 30.0])
+        self.assertEqual(contract.total_amount, 70.0)
+
+    def test_generation_shards(self):
+        """
+            Groups are dispatched by partner in disjoint shards, each one
+            generated by its own job of the invoicer.
+        """
+        groups = self.create_group({'partner_id': self.michel.id})
+        groups += self.create_group({'partner_id': self.michel.id})
+        groups += self.create_group({'partner_id': self.thomas.id})
+        groups += self.create_group({'partner_id': self.david.id})
+        shards = groups._split_in_shards(2)
+        self.assertLessEqual(len(shards), 2)
+        self.assertEqual(sum(len(s) for s in shards), len(groups))
+        # Groups of the same partner are in the same shard
+        self.assertTrue(any(groups[:2] <= shard for shard in shards))
+
+        invoicer = self.env['recurring.invoicer'].create({
+            'source': 'test'})
+        self.env['ir.config_parameter'].set_param(
+            'recurring_contract.generation_shards', '2')
+        groups.with_context(async_mode=True).generate_invoices(invoicer)
+        self.assertEqual(len(invoicer.shard_ids), len(shards))
+        self.assertEqual(sum(invoicer.shard_ids.mapped('nb_groups')), 4)
+        self.assertEqual(invoicer.state, 'pending')
+
+    def test_group_next_invoice_date(self):
+        """
+            The next invoice date of a group is the first date of its active
+            contracts, or empty if one of them has no date.
+        """
+        group = self.create_group({'partner_id': self.thomas.id})
+        today = fields.Date.from_string(fields.Date.today())
+        next_month = fields.Date.to_string(today + relativedelta(months=1))
+        contract = self.create_contract(
+            {'partner_id': self.thomas.id, 'group_id': group.id,
+             'next_invoice_date': next_month},
+            [{'amount': 10.0}])
+        # The earlier date of the draft contract is ignored
+        draft_contract = self.create_contract(
+            {'partner_id': self.thomas.id, 'group_id': group.id},
+            [{'amount': 20.0}])
+        contract.write({'state': 'active'})
+        self.assertEqual(group.next_invoice_date, next_month)
+
+        # Unsaved groups are computed without the grouped query
+        new_group = self.group_obj.new({
+            'contract_ids': [(6, 0, (contract + draft_contract).ids)]})
+        self.assertEqual(new_group.next_invoice_date, next_month)
+
+        undated_contract = self.create_contract(
+            {'partner_id': self.thomas.id, 'group_id': group.id,
+             'next_invoice_date': False},
+            [{'amount': 30.0}])
+        undated_contract.write({'state': 'active'})
+        self.assertFalse(group.next_invoice_date)
+
+    def test_generation_metrics(self):
+        """
+            The invoicer and its shards give the metrics of the generation.
+        """
+        groups = self.create_group({'partner_id': self.michel.id})
+        groups += self.create_group({'partner_id': self.thomas.id})
+        contracts = self.con_obj
+        for group in groups:
+            contracts |= self.create_contract(
+                {'partner_id': group.partner_id.id, 'group_id': group.id},
+                [{'amount': 40.0}, {'amount': 10.0}])
+        contracts.signal_workflow('contract_validated')
+
+        # Each reading of the clock is one second later than the previous
+        with mock.patch.object(contract_group_module, 'time') as clock:
+            clock.time.side_effect = itertools.count().next
+            invoicer = groups._generate_invoices()
+        self.assertEqual(invoicer.state, 'done')
+        self.assertEqual(invoicer.nb_invoices, 4)
+        self.assertEqual(invoicer.nb_invoice_lines, 8)
+        self.assertFalse(invoicer.nb_failures)
+        shard = invoicer.shard_ids
+        self.assertEqual(shard.nb_groups, 2)
+        self.assertEqual(shard.nb_groups_done, 2)
+        for phase in ('setup', 'create', 'validate', 'next_date'):
+            self.assertGreater(shard['time_' + phase], 0)
+        self.assertGreater(shard.time_group_p50, 0)
+        self.assertGreaterEqual(shard.time_group_p95, shard.time_group_p50)
+
+    def test_generation_releases_chunks_cache(self):
+        """
+            Records of a chunk are removed from the cache once its invoices
+            are generated.
+        """
+        self.env['ir.config_parameter'].set_param(
+            'recurring_contract.generation_chunk_size', '1')
+        groups = self.create_group({'partner_id': self.michel.id})
+        groups += self.create_group({'partner_id': self.thomas.id})
+        contracts = self.con_obj
+        for group in groups:
+            contracts |= self.create_contract(
+                {'partner_id': group.partner_id.id, 'group_id': group.id},
+                [{'amount': 40.0}])
+        contracts.signal_workflow('contract_validated')
+
+        invoicer = groups._generate_invoices()
+        self.assertEqual(len(invoicer.shard_ids), 1)
+        self.assertGreater(invoicer.shard_ids.memory_peak, 0)
+        cached_ids = {'recurring.contract.group': set(),
+                      'recurring.contract': set()}
+        for env in self.env.all:
+            for field, values in env.cache.iteritems():
+                if field.model_name in cached_ids:
+                    cached_ids[field.model_name].update(values)
+        self.assertFalse(cached_ids['recurring.contract.group'] &
+                         set(groups.ids))
+        self.assertFalse(cached_ids['recurring.contract'] &
+                         set(contracts.ids))
+
+    def test_update_next_invoice_date(self):
+        """
+            Contracts with the same recurrence are moved together, without
+            tracking the change in each contract: one message is posted on
+            the group for each move.
+        """
+        group = self.create_group({'partner_id': self.thomas.id})
+        group2 = self.create_group({
+            'partner_id': self.david.id,
+            'recurring_value': 2,
+        })
+        group3 = self.create_group({'partner_id': self.michel.id})
+        other_contract = self.create_contract(
+            {'partner_id': self.michel.id, 'group_id': group3.id},
+            [{'amount': 40.0}])
+        contracts = self.create_contract(
+            {'partner_id': self.thomas.id, 'group_id': group.id},
+            [{'amount': 10.0}])
+        contracts += self.create_contract(
+            {'partner_id': self.thomas.id, 'group_id': group.id},
+            [{'amount': 20.0}])
+        contracts += self.create_contract(
+            {'partner_id': self.david.id, 'group_id': group2.id},
+            [{'amount': 30.0}])
+        nb_messages = len(contracts.mapped('message_ids'))
+        nb_group_messages = len(group.message_ids)
+
+        (contracts + other_contract).update_next_invoice_date()
+        today = fields.Date.from_string(fields.Date.today())
+        self.assertEqual(
+            contracts[:2].mapped('next_invoice_date'),
+            [fields.Date.to_string(today + relativedelta(months=1))] * 2)
+        self.assertEqual(
+            contracts[2].next_invoice_date,
+            fields.Date.to_string(today + relativedelta(months=2)))
+        self.assertEqual(
+            len(contracts.mapped('message_ids')), nb_messages)
+        group.invalidate_cache(['message_ids'], group.ids)
+        self.assertEqual(len(group.message_ids), nb_group_messages + 1)
+        self.assertIn(contracts[1].reference, group.message_ids[0].body)
+        # Groups moved in the same batch only list their own contracts
+        self.assertNotIn(
+            other_contract.reference, group.message_ids[0].body)
+
+    def test_write_next_invoice_date(self):
+        """
+            The next invoice date of several contracts is written at once,
+            but cannot be rewound.
+        """
+        group = self.create_group({'partner_id': self.thomas.id})
+        contracts = self.con_obj
+        for amount in (10.0, 20.0):
+            contracts |= self.create_contract(
+                {'partner_id': self.thomas.id, 'group_id': group.id},
+                [{'amount': amount}])
+        today = fields.Date.from_string(fields.Date.today())
+        next_month = fields.Date.to_string(today + relativedelta(months=1))
+        contracts.write({'next_invoice_date': next_month})
+        self.assertEqual(
+            contracts.mapped('next_invoice_date'), [next_month] * 2)
+        with self.assertRaises(UserError):
+            contracts.write({'next_invoice_date': fields.Date.today()})
+
+    def test_rewind_next_invoice_date(self):
+        """
+            Contracts of a group are rewound together after the last
+            invoice that is not cancelled.
+        """
+        group = self.create_group({'partner_id': self.michel.id})
+        contracts = self.con_obj
+        for amount in (10.0, 20.0):
+            contracts |= self.create_contract(
+                {'partner_id': self.michel.id, 'group_id': group.id},
+                [{'amount': amount}])
+        contracts.signal_workflow('contract_validated')
+        invoices = group.generate_invoices().invoice_ids
+        self.assertEqual(len(invoices), 2)
+        today = fields.Date.from_string(fields.Date.today())
+        next_month = fields.Date.to_string(today + relativedelta(months=1))
+        invoices.filtered(
+            lambda i: i.date_invoice == next_month).action_invoice_cancel()
+
+        contracts.rewind_next_invoice_date()
+        self.assertEqual(
+            contracts.mapped('next_invoice_date'), [next_month] * 2)
+
+    def test_invoice_forecast(self):
+        """
+            The forecast gives the amounts of the next months without
+            generating any invoice.
+        """
+        group = self.create_group({'partner_id': self.thomas.id})
+        contract = self.create_contract(
+            {'partner_id': self.thomas.id, 'group_id': group.id},
+            [{'amount': 40.0}, {'amount': 10.0, 'quantity': 2}])
+        contract.signal_workflow('contract_validated')
+
+        forecast = group.get_invoice_forecast(nb_months=3)
+        self.assertEqual(len(set(f['month'] for f in forecast)), 4)
+        self.assertEqual(sum(f['amount'] for f in forecast), 4 * 60.0)
+        self.assertEqual(set(f['payment_mode_id'] for f in forecast),
+                         {self.payment_mode.id})
+        self.assertFalse(contract.invoice_line_ids)
+
+        # Empty lines data returned by overrides are skipped
+        contract_class = type(contract)
+        get_inv_lines_data = contract_class.get_inv_lines_data
+        with mock.patch.object(
+                contract_class, 'get_inv_lines_data',
+                lambda c: get_inv_lines_data(c) + [{}]):
+            forecast = group.get_invoice_forecast(nb_months=3)
+        self.assertEqual(sum(f['amount'] for f in forecast), 4 * 60.0)
+
+    def test_last_paid_invoice_date(self):
+        """
+            The last paid invoice date is stored and follows the state of
+            the invoices.
+        """
+        group = self.create_group({'partner_id': self.thomas.id})
+        contract = self.create_contract(
+            {'partner_id': self.thomas.id, 'group_id': group.id},
+            [{'amount': 40.0}])
+        contract.signal_workflow('contract_validated')
+        invoice = group.generate_invoices().invoice_ids[0]
+        self.assertFalse(contract.last_paid_invoice_date)
+
+        invoice.write({'state': 'paid'})
+        self.assertEqual(contract.last_paid_invoice_date,
+                         invoice.date_invoice)
+        self.assertEqual(group.last_paid_invoice_date, invoice.date_invoice)
+        self.assertEqual(self.con_obj.search([
+            ('last_paid_invoice_date', '=', invoice.date_invoice),
+            ('group_id', '=', group.id)]), contract)
+
+        invoice.write({'state': 'open'})
+        self.assertFalse(contract.last_paid_invoice_date)
+        self.assertFalse(group.last_paid_invoice_date)
+        nb_invoices = contract.nb_invoices
+        invoice.action_invoice_cancel()
+        self.assertEqual(contract.nb_invoices, nb_invoices - 1)
+
+    def test_generation_failure_isolation(self):
+        """
+            A group failing during the generation is rolled back alone and
+            recorded on the invoicer.
+        """
+        group_ok = self.create_group({'partner_id': self.michel.id})
+        group_ko = self.create_group({'partner_id': self.thomas.id})
+        contract_ok = self.create_contract(
+            {'partner_id': self.michel.id, 'group_id': group_ok.id},
+            [{'amount': 40.0}])
+        contract_ko = self.create_contract(
+            {'partner_id': self.thomas.id, 'group_id': group_ko.id},
+            [{'amount': 40.0}])
+        (contract_ok + contract_ko).signal_workflow('contract_validated')
+        next_date = contract_ko.next_invoice_date
+
+        group_class = type(group_ok)
+        setup_inv_data = group_class._setup_inv_data
+
+        def _setup_inv_data(group, *args):
+            if group == group_ko:
+                raise UserError('Generation failure')
+            return setup_inv_data(group, *args)
+
+        with mock.patch.object(
+                group_class, '_setup_inv_data', _setup_inv_data):
+            invoicer = (group_ok + group_ko)._generate_invoices()
+            # The retry job is postponed while the group still fails
+            with self.assertRaises(RetryableJobError):
+                invoicer._retry_failed_groups()
+
+        self.assertEqual(
+            invoicer.mapped('invoice_ids.invoice_line_ids.contract_id'),
+            contract_ok)
+        self.assertFalse(contract_ko.invoice_line_ids)
+        self.assertEqual(contract_ko.next_invoice_date, next_date)
+        self.assertEqual(invoicer.failure_ids.group_id, group_ko)
+        self.assertIn('Generation failure', invoicer.failure_ids.error)
+        # The group failed in the generation and in the retry job
+        self.assertEqual(sum(invoicer.shard_ids.mapped('nb_failures')), 2)
+        self.assertEqual(invoicer.nb_failures, 1)
+        self.assertIn('UserError', invoicer.failure_ids.traceback)
+
+        # Retry the generation once the failure is solved
+        invoicer._retry_failed_groups()
+        self.assertFalse(invoicer.failure_ids)
+        self.assertEqual(invoicer.nb_failures, 0)
+        self.assertTrue(contract_ko.invoice_line_ids)
+
+    def test_generation_posting_lock(self):
+        """
+            Invoices are generated and validated while holding the lock on
+            the journal sequence. A group failing at validation keeps
+            neither draft invoices nor its moved next invoice date.
+        """
+        group_ok = self.create_group({'partner_id': self.michel.id})
+        group_ko = self.create_group({'partner_id': self.thomas.id})
+        contract_ok = self.create_contract(
+            {'partner_id': self.michel.id, 'group_id': group_ok.id},
+            [{'amount': 40.0}])
+        contract_ko = self.create_contract(
+            {'partner_id': self.thomas.id, 'group_id': group_ko.id},
+            [{'amount': 40.0}])
+        (contract_ok + contract_ko).signal_workflow('contract_validated')
+        next_date = contract_ko.next_invoice_date
+        journal = self.env['account.journal'].search(
+            [('type', '=', 'sale'), ('company_id', '=', 1)], limit=1)
+        locked = list()
+
+        invoice_class = type(self.env['account.invoice'])
+        action_invoice_open = invoice_class.action_invoice_open
+
+        def _action_invoice_open(invoices):
+            # The lock is held by the job while validating
+            with self.registry.cursor() as cr:
+                cr.execute("SELECT pg_try_advisory_xact_lock(%s, %s)", (
+                    contract_group_module.POSTING_LOCK_KEY,
+                    journal.sequence_id.id))
+                locked.append(not cr.fetchone()[0])
+            if invoices.mapped('partner_id') & self.thomas:
+                raise UserError('Validation failure')
+            return action_invoice_open(invoices)
+
+        with mock.patch.object(
+                invoice_class, 'action_invoice_open', _action_invoice_open):
+            invoicer = (group_ok + group_ko)._generate_invoices()
+
+        self.assertTrue(locked)
+        self.assertTrue(all(locked))
+        self.assertEqual(invoicer.failure_ids.group_id, group_ko)
+        self.assertTrue(contract_ok.invoice_line_ids)
+        self.assertFalse(contract_ko.invoice_line_ids)
+        self.assertEqual(contract_ko.next_invoice_date, next_date)
+
+    def test_generation_skips_locked_groups(self):
+        """
+            A group locked by another job is skipped, without waiting and
+            without being recorded as a failure.
+        """
+        # The group must be committed to be seen by the other cursors
+        with self.registry.cursor() as cr:
+            env = api.Environment(cr, self.uid, {})
+            group_id = env['recurring.contract.group'].create({
+                'partner_id': self.michel.id,
+                'payment_mode_id': self.payment_mode.id,
+            }).id
+            cr.execute("""
+                UPDATE recurring_contract_group
+                SET next_invoice_date = CURRENT_DATE WHERE id = %s
+            """, [group_id])
+        lock_cr = self.registry.cursor()
+        try:
+            lock_cr.execute("""
+                SELECT id FROM recurring_contract_group
+                WHERE id = %s FOR UPDATE
+            """, [group_id])
+            job_cr = self.registry.cursor()
+            try:
+                env = api.Environment(job_cr, self.uid, {})
+                group = env['recurring.contract.group'].browse(group_id)
+                invoicer = group._generate_invoices()
+                self.assertEqual(invoicer.shard_ids.state, 'done')
+                self.assertFalse(invoicer.invoice_ids)
+                self.assertFalse(invoicer.failure_ids)
+                self.assertEqual(invoicer.nb_failures, 0)
+            finally:
+                job_cr.rollback()
+                job_cr.close()
+        finally:
+            lock_cr.rollback()
+            lock_cr.close()
+            with self.registry.cursor() as cr:
+                env = api.Environment(cr, self.uid, {})
+                env['recurring.contract.group'].browse(group_id).unlink()
@@ -28,14 +28,12 @@ class InvoicerWizard(models.TransientModel):
         date_limit = datetime.date.today() + relativedelta(months=+1)
 
         recurring_invoicer_obj = self.env['recurring.invoicer']
-        contract_groups = self.env['recurring.contract.group'].search([
-            ('next_invoice_date', '<=', date_limit),
-            ('next_invoice_date', '!=', False)])
+        contract_groups = self.env[
+            'recurring.contract.group']._search_due_groups(date_limit)
 
         invoicer = recurring_invoicer_obj.create({'source': self._name})
-        # Add a job for all groups and start the job when all jobs are created.
-        for group in contract_groups:
-            group.generate_invoices(invoicer)
+        # Split the groups in several jobs that run concurrently.
+        contract_groups.generate_invoices(invoicer)
 
         return {
             'name': 'recurring.invoicer.form',